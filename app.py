@@ -2,19 +2,41 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import atexit
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
+from flask import Flask, Response, request, jsonify, g, has_request_context, stream_with_context
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError, ConnectionFailure
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import smtplib
 import random
 import hashlib
+import hmac
+import base64
 import secrets
+import heapq
+import copy
+import time
+import threading
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import logging
+import mmap
+import struct
+import sys
+import click
+from urllib.parse import urlsplit
+
+try:
+    import ahocorasick  # optional: pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -42,14 +64,107 @@ PRICING_PLANS = {
     'monthly': {'price': 3000, 'duration': 30, 'name': 'Monthly Premium'}
 }
 
+FREE_DAILY_CHECKS = 5
+
+# Wrong guesses allowed before an OTP is invalidated
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', 5))
+
+# Most items accepted by one /api/check-sms/batch or /api/check-ussd/batch request
+SCAN_BATCH_MAX = int(os.environ.get('SCAN_BATCH_MAX', 100))
+# Longest single message a batch item may be (a 10-part concatenated SMS is ~1,530)
+SCAN_ITEM_MAX_CHARS = int(os.environ.get('SCAN_ITEM_MAX_CHARS', 2000))
+# Request bodies above this are refused before they are buffered
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_BYTES', 1024 * 1024))
+
 # Get email configuration from environment variables
 EMAIL_CONFIG = {
     'sender_email': os.environ.get('SENDER_EMAIL', ''),
     'sender_password': os.environ.get('EMAIL_PASSWORD', ''),
-    'smtp_server': 'smtp.gmail.com',
-    'smtp_port': 587
+    'smtp_server': os.environ.get('SMTP_SERVER', 'smtp.gmail.com'),
+    'smtp_port': int(os.environ.get('SMTP_PORT', 587)),
+    'smtp_starttls': os.environ.get('SMTP_STARTTLS', 'true').lower() == 'true',
+    # 'smtp', or 'memory' / 'file' to capture mail instead of sending it
+    'transport': os.environ.get('EMAIL_TRANSPORT', 'smtp').lower(),
+    'file_dir': os.environ.get('EMAIL_FILE_DIR', 'sent_emails')
 }
 
+# Storage backend: 'mongodb' (falls back to in-memory when unreachable),
+# 'sqlite' for a single-node deployment without Atlas, or 'memory'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongodb').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'cyberguard.db')
+
+# Session mode: 'database' (random token, one session document each) or
+# 'signed' (HMAC-signed token checked without a database read; needs SESSION_SECRET)
+SESSION_MODE = os.environ.get('SESSION_MODE', 'database').lower()
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+SESSION_DAYS = 30
+
+# =============================================
+# DATABASE CIRCUIT BREAKER
+# =============================================
+
+class CircuitBreaker:
+    """Closed -> open on failure; after an exponential backoff one background probe runs (half-open)"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, base_delay=5, max_delay=300):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.last_failure_at = None
+        self.retry_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self, probe):
+        """True when the caller may connect inline; otherwise maybe start the background probe"""
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.HALF_OPEN or time.time() < self.retry_at:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+
+        threading.Thread(target=self._run_probe, args=(probe,), daemon=True).start()
+        return False
+
+    def _run_probe(self, probe):
+        try:
+            probe()
+            self.record_success()
+            logger.info("✅ MongoDB probe succeeded - circuit closed")
+        except Exception as e:
+            logger.error(f"❌ MongoDB probe failed: {e}")
+            self.record_failure()
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.retry_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.last_failure_at = time.time()
+            delay = min(self.base_delay * 2 ** (self.failures - 1), self.max_delay)
+            self.retry_at = self.last_failure_at + delay
+            self.state = CircuitBreaker.OPEN
+            logger.warning(f"⚡ MongoDB circuit open - next probe in {delay}s")
+
+    def status(self):
+        def iso(ts):
+            return datetime.fromtimestamp(ts).isoformat() if ts else None
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'last_failure_at': iso(self.last_failure_at),
+            'retry_at': iso(self.retry_at)
+        }
+
 # =============================================
 # ENHANCED DATABASE MANAGER WITH MONGODB
 # =============================================
@@ -58,286 +173,1761 @@ EMAIL_CONFIG = {
 class Database:
     _client = None
     _db = None
+
+    # Bump SCHEMA_VERSION whenever COLLECTIONS or INDEXES change
+    SCHEMA_VERSION = 4
+    SCHEMA_COLLECTION = 'schema_version'
+    COLLECTIONS = [
+        'users', 'payments', 'sessions', 'otp_storage', 'revoked_sessions', 'reset_tokens', 'email_outbox'
+    ]
+    _mongo_backend = None
+    _local = None
+    _backend_lock = threading.Lock()
+    _connect_lock = threading.Lock()
+    breaker = CircuitBreaker(
+        base_delay=float(os.environ.get('DB_BREAKER_BASE_SECONDS', 5)),
+        max_delay=float(os.environ.get('DB_BREAKER_MAX_SECONDS', 300))
+    )
+
+    # Indexes created at bootstrap; email is unique only where it is a string
+    # so legacy documents without an email don't collide on null
+    INDEXES = {
+        'users': [
+            {
+                'keys': [('email', ASCENDING)],
+                'name': 'email_unique',
+                'unique': True,
+                'partialFilterExpression': {'email': {'$type': 'string'}}
+            },
+            {'keys': [('phone_number', ASCENDING)], 'name': 'phone_number'}
+        ],
+        # TTL indexes: MongoDB deletes the document once expires_at (a real datetime) passes
+        'sessions': [
+            {'keys': [('expires_at', ASCENDING)], 'name': 'expires_at_ttl', 'expireAfterSeconds': 0}
+        ],
+        'otp_storage': [
+            {'keys': [('expires_at', ASCENDING)], 'name': 'expires_at_ttl', 'expireAfterSeconds': 0}
+        ],
+        # Logged-out signed sessions, kept only until the token would have expired anyway
+        'revoked_sessions': [
+            {'keys': [('expires_at', ASCENDING)], 'name': 'expires_at_ttl', 'expireAfterSeconds': 0}
+        ],
+        # Password reset tokens, keyed by the SHA-256 of the token
+        'reset_tokens': [
+            {'keys': [('expires_at', ASCENDING)], 'name': 'expires_at_ttl', 'expireAfterSeconds': 0}
+        ],
+        # Outgoing mail; every row expires within EmailOutbox.RETENTION
+        'email_outbox': [
+            {'keys': [('status', ASCENDING), ('next_attempt_at', ASCENDING)], 'name': 'status_next_attempt'},
+            {'keys': [('expires_at', ASCENDING)], 'name': 'expires_at_ttl', 'expireAfterSeconds': 0}
+        ]
+    }
     
     @staticmethod
     def get_db():
         if Database._db is None:
-            try:
-                # Get connection string - prioritize Vercel MongoDB
-                connection_string = (
-                    os.environ.get('MONGODB_ATLAS_URI') or  # Vercel MongoDB integration
-                    os.environ.get('MONGODB_URI') or        # Your current
-                    os.environ.get('DATABASE_URL')          # Generic fallback
-                )
-                
-                if not connection_string:
-                    logger.warning("❌ No MongoDB connection string found")
-                    return None
-                
-                # Mask for logging
-                if '@' in connection_string:
-                    parts = connection_string.split('@')
-                    user_part = parts[0]
-                    if ':' in user_part:
-                        user_pass = user_part.split(':')
-                        masked = user_pass[0] + ':••••••••@' + parts[1]
-                        logger.info(f"🔗 Connecting to MongoDB: {masked}")
-                
-                # Connect with optimized settings for Vercel
-                Database._client = MongoClient(
-                    connection_string,
-                    serverSelectionTimeoutMS=10000,
-                    maxPoolSize=10,
-                    connectTimeoutMS=10000,
-                    socketTimeoutMS=30000
-                )
-                
-                # Test connection
-                Database._client.admin.command('ping')
-                
-                # Extract database name
-                db_name = 'atlas-purple-book'  # Default
-                
-                # Try to extract from connection string
-                if '.mongodb.net/' in connection_string:
-                    try:
-                        parts = connection_string.split('.mongodb.net/')
-                        if len(parts) > 1:
-                            db_part = parts[1].split('?')[0]
-                            if db_part and db_part.strip():
-                                db_name = db_part
-                    except:
-                        pass
-                
-                Database._db = Database._client[db_name]
-                logger.info(f"✅ Connected to MongoDB: {db_name}")
-                
-                # Create collections if needed
-                collections = ['users', 'payments', 'sessions', 'otp_storage']
-                existing = Database._db.list_collection_names()
-                
-                for collection in collections:
-                    if collection not in existing:
-                        Database._db.create_collection(collection)
-                        logger.info(f"📁 Created collection: {collection}")
-                
-                return Database._db
-                
-            except Exception as e:
-                logger.error(f"❌ MongoDB connection failed: {e}")
-                # NO SQLITE FALLBACK ON VERCEL
-                if os.environ.get('VERCEL') == '1':
-                    logger.error("🚨 MongoDB failed on Vercel - check environment variables")
+            # Get connection string - prioritize Vercel MongoDB
+            connection_string = (
+                os.environ.get('MONGODB_ATLAS_URI') or  # Vercel MongoDB integration
+                os.environ.get('MONGODB_URI') or        # Your current
+                os.environ.get('DATABASE_URL')          # Generic fallback
+            )
+            
+            if not connection_string:
+                logger.warning("❌ No MongoDB connection string found")
                 return None
+
+            # While the breaker is open, fail over to in-memory immediately
+            if not Database.breaker.allow_request(lambda: Database._connect(connection_string)):
+                return None
+
+            # One cold-start connect at a time; the others wait and reuse its client
+            with Database._connect_lock:
+                if Database._db is not None:
+                    return Database._db
+                # The connect this request waited on may have failed and opened the breaker
+                if not Database.breaker.allow_request(lambda: Database._connect(connection_string)):
+                    return None
+                try:
+                    Database._connect(connection_string)
+                    Database.breaker.record_success()
+                except Exception as e:
+                    logger.error(f"❌ MongoDB connection failed: {e}")
+                    Database.breaker.record_failure()
+                    # NO SQLITE FALLBACK ON VERCEL
+                    if os.environ.get('VERCEL') == '1':
+                        logger.error("🚨 MongoDB failed on Vercel - check environment variables")
+                    return None
         return Database._db
-    
+
     @staticmethod
-    def get_collection(collection_name):
-        db = Database.get_db()
-        if db is not None:
+    def _connect(connection_string):
+        """Open the client, confirm the schema version and migrate if it is stale; raises on failure"""
+        # Mask for logging
+        if '@' in connection_string:
+            parts = connection_string.split('@')
+            user_part = parts[0]
+            if ':' in user_part:
+                user_pass = user_part.split(':')
+                masked = user_pass[0] + ':••••••••@' + parts[1]
+                logger.info(f"🔗 Connecting to MongoDB: {masked}")
+        
+        # Connect with optimized settings for Vercel
+        client = MongoClient(
+            connection_string,
+            serverSelectionTimeoutMS=10000,
+            maxPoolSize=10,
+            connectTimeoutMS=10000,
+            socketTimeoutMS=30000
+        )
+        
+        # Extract database name
+        db_name = 'atlas-purple-book'  # Default
+        
+        # Try to extract from connection string
+        if '.mongodb.net/' in connection_string:
             try:
-                return db[collection_name]
+                parts = connection_string.split('.mongodb.net/')
+                if len(parts) > 1:
+                    db_part = parts[1].split('?')[0]
+                    if db_part and db_part.strip():
+                        db_name = db_part
+            except:
+                pass
+        
+        db = client[db_name]
+        try:
+            # Reading the schema version doubles as the connectivity check,
+            # so a migrated database costs one round trip on cold start
+            schema = db[Database.SCHEMA_COLLECTION].find_one({'_id': 'schema'})
+        except Exception:
+            client.close()
+            raise
+        logger.info(f"✅ Connected to MongoDB: {db_name}")
+        
+        if not schema or schema.get('version') != Database.SCHEMA_VERSION:
+            logger.warning("⚠️ Schema not migrated - run `flask --app app migrate-db`; migrating now")
+            Database.migrate(db)
+        
+        Database._client = client
+        Database._db = db
+        return db
+
+    @staticmethod
+    def migrate(db):
+        """Create collections and indexes, then record SCHEMA_VERSION (idempotent)"""
+        existing = db.list_collection_names()
+        for collection in Database.COLLECTIONS:
+            if collection not in existing:
+                db.create_collection(collection)
+                logger.info(f"📁 Created collection: {collection}")
+        
+        Database.ensure_indexes(db)
+        db[Database.SCHEMA_COLLECTION].replace_one(
+            {'_id': 'schema'},
+            {'_id': 'schema', 'version': Database.SCHEMA_VERSION, 'applied_at': datetime.utcnow()},
+            upsert=True
+        )
+        logger.info(f"🗂️ Schema at version {Database.SCHEMA_VERSION}")
+
+    @staticmethod
+    def schema_version(db=None):
+        if db is None:
+            db = Database.get_db()
+        if db is None:
+            return None
+        try:
+            schema = db[Database.SCHEMA_COLLECTION].find_one({'_id': 'schema'})
+            return schema.get('version') if schema else None
+        except Exception as e:
+            logger.error(f"Error reading schema version: {e}")
+            return None
+
+    @staticmethod
+    def _check_connection_error(e):
+        """Trip the breaker when Atlas becomes unreachable after we connected"""
+        if isinstance(e, ConnectionFailure) and Database._db is not None:
+            logger.error("🔌 Lost MongoDB connection - switching to in-memory fallback")
+            client = Database._client
+            Database._client = None
+            Database._db = None
+            Database.breaker.record_failure()
+            if client is not None:
+                client.close()
+
+    @staticmethod
+    def _count_op():
+        """Tally a database operation against the current request, if any"""
+        uow = UnitOfWork.current()
+        if uow is not None:
+            uow.db_ops += 1
+
+    @staticmethod
+    def ttl_field(collection_name):
+        for index in Database.INDEXES.get(collection_name, []):
+            if 'expireAfterSeconds' in index:
+                return index['keys'][0][0]
+        return None
+
+    @staticmethod
+    def _unique_fields(collection_name):
+        return [
+            index['keys'][0][0] for index in Database.INDEXES.get(collection_name, [])
+            if index.get('unique') and len(index['keys']) == 1
+        ]
+
+    @staticmethod
+    def ensure_indexes(db):
+        """Create the indexes in INDEXES (idempotent) and log any that are missing"""
+        for collection_name, indexes in Database.INDEXES.items():
+            for index in indexes:
+                options = {k: v for k, v in index.items() if k != 'keys'}
+                try:
+                    db[collection_name].create_index(index['keys'], **options)
+                except Exception as e:
+                    logger.error(f"❌ Failed to create index {collection_name}.{index['name']}: {e}")
+
+        for collection_name, indexes in Database.index_status(db).items():
+            for name, present in indexes.items():
+                if not present:
+                    logger.warning(f"⚠️ Missing index {collection_name}.{name}")
+
+    @staticmethod
+    def index_status(db=None):
+        """Report which of the expected indexes exist, per collection"""
+        if db is None:
+            db = Database.get_db()
+        status = {}
+        for collection_name, indexes in Database.INDEXES.items():
+            try:
+                existing = db[collection_name].index_information() if db is not None else {}
             except Exception as e:
-                logger.error(f"Error getting collection {collection_name}: {e}")
-        
-        # Only in-memory fallback (no SQLite)
-        logger.warning(f"⚠️ Using in-memory fallback for {collection_name}")
-        if not hasattr(Database, '_in_memory_storage'):
-            Database._in_memory_storage = {
-                'users': {},
-                'payments': {},
-                'sessions': {},
-                'otp_storage': {}
-            }
-        return Database._in_memory_storage.get(collection_name, {})
-    
+                logger.error(f"Error reading indexes for {collection_name}: {e}")
+                existing = {}
+            status[collection_name] = {index['name']: index['name'] in existing for index in indexes}
+        return status
+
+    @staticmethod
+    def backend():
+        """The storage backend serving this call, per STORAGE_BACKEND"""
+        if STORAGE_BACKEND == 'sqlite':
+            return Database._local_backend(SQLiteBackend)
+        if STORAGE_BACKEND == 'memory':
+            return Database._local_backend(MemoryBackend)
+
+        db = Database.get_db()
+        if db is not None:
+            if Database._mongo_backend is None or Database._mongo_backend.db is not db:
+                Database._mongo_backend = MongoBackend(db)
+            return Database._mongo_backend
+
+        # Only in-memory fallback when MongoDB is selected but unreachable
+        logger.warning("⚠️ Using in-memory fallback")
+        return Database._local_backend(MemoryBackend)
+
+    @staticmethod
+    def _local_backend(backend_class):
+        with Database._backend_lock:
+            if not isinstance(Database._local, backend_class):
+                Database._local = backend_class()
+            return Database._local
+
+    # =============================================
+    # POINT-LOOKUP DATA ACCESS (keyed by _id)
+    # =============================================
+
+    @staticmethod
+    def find_one(collection_name, doc_id):
+        """Fetch a single document by _id"""
+        try:
+            Database._count_op()
+            return Database.backend().find_one(collection_name, doc_id)
+        except Exception as e:
+            logger.error(f"Error loading {collection_name}/{doc_id}: {e}")
+            Database._check_connection_error(e)
+            return None
+
+    @staticmethod
+    def insert_one(collection_name, doc_id, doc):
+        """Insert a new document; raises DuplicateKeyError on a unique index violation"""
+        Database._count_op()
+        return Database.backend().insert_one(collection_name, doc_id, doc)
+
+    @staticmethod
+    def replace_one(collection_name, doc_id, doc):
+        """Insert or replace a single document by _id"""
+        try:
+            Database._count_op()
+            return Database.backend().replace_one(collection_name, doc_id, doc)
+        except Exception as e:
+            logger.error(f"Error saving {collection_name}/{doc_id}: {e}")
+            Database._check_connection_error(e)
+            return False
+
+    @staticmethod
+    def update_one(collection_name, doc_id, fields, upsert=False, inc=None, unset=None):
+        """$set/$inc/$unset the given fields on a single document by _id"""
+        try:
+            Database._count_op()
+            return Database.backend().update_one(collection_name, doc_id, fields, upsert, inc, unset)
+        except Exception as e:
+            logger.error(f"Error updating {collection_name}/{doc_id}: {e}")
+            Database._check_connection_error(e)
+            return False
+
+    @staticmethod
+    def delete_one(collection_name, doc_id):
+        """Delete a single document by _id"""
+        try:
+            Database._count_op()
+            return Database.backend().delete_one(collection_name, doc_id)
+        except Exception as e:
+            logger.error(f"Error deleting {collection_name}/{doc_id}: {e}")
+            Database._check_connection_error(e)
+            return False
+
+    @staticmethod
+    def find_one_and_update(collection_name, doc_id, match, fields=None, inc=None):
+        """Atomically update a document by _id if its fields equal `match`; returns the pre-image or None"""
+        try:
+            Database._count_op()
+            return Database.backend().find_one_and_update(collection_name, doc_id, match, fields, inc)
+        except Exception as e:
+            logger.error(f"Error updating {collection_name}/{doc_id}: {e}")
+            Database._check_connection_error(e)
+            return None
+
+    @staticmethod
+    def find_one_by(collection_name, field, value):
+        """Fetch a single document by an indexed field"""
+        try:
+            Database._count_op()
+            return Database.backend().find_one_by(collection_name, field, value)
+        except Exception as e:
+            logger.error(f"Error loading {collection_name} by {field}: {e}")
+            Database._check_connection_error(e)
+            return None
+
+    @staticmethod
+    def find_by(collection_name, field, value, limit=100, before=None):
+        """Fetch up to `limit` documents by an indexed field.
+
+        before=(field, cutoff) also requires field <= cutoff, oldest first.
+        """
+        try:
+            Database._count_op()
+            return Database.backend().find_by(collection_name, field, value, limit, before)
+        except Exception as e:
+            logger.error(f"Error loading {collection_name} by {field}: {e}")
+            Database._check_connection_error(e)
+            return []
+
+    @staticmethod
+    def count(collection_name):
+        try:
+            Database._count_op()
+            return Database.backend().count(collection_name)
+        except Exception as e:
+            logger.error(f"Error counting {collection_name}: {e}")
+            Database._check_connection_error(e)
+            return 0
+
+    # User reads go through user_cache; every user write below keeps it coherent
+
+    @staticmethod
+    def get_user(user_id, fresh=False):
+        cached = None if fresh else user_cache.get(user_id)
+        if cached is not None:
+            return UserRecord(cached)
+        version = user_cache.version()
+        user = Database.find_one('users', user_id)
+        user_cache.fill(user, version)
+        return UserRecord.wrap(user)
+
+    @staticmethod
+    def get_user_by_email(email, fresh=False):
+        """fresh=True skips the cache, for checks another instance's write must not lag behind"""
+        cached = None if fresh else user_cache.get_by_email(email)
+        if cached is not None:
+            return UserRecord(cached)
+        version = user_cache.version()
+        user = Database.find_one_by('users', 'email', email)
+        user_cache.fill(user, version)
+        return UserRecord.wrap(user)
+
+    @staticmethod
+    def insert_user(user):
+        try:
+            return Database.insert_one('users', user['id'], user)
+        finally:
+            user_cache.invalidate(user['id'])
+
+    @staticmethod
+    def update_user_fields(user_id, fields):
+        if Database.update_one('users', user_id, fields):
+            user_cache.update(user_id, Database.backend().as_stored('users', fields))
+            return True
+        user_cache.invalidate(user_id)
+        return False
+
+    @staticmethod
+    def save_user_record(user):
+        """Write only the fields a UserRecord has changed since it was loaded"""
+        if not user.is_dirty():
+            return True
+        sets, incs, unsets = user.pending_changes()
+        if Database.update_one('users', user['id'], sets, inc=incs, unset=unsets):
+            if incs:
+                # The stored total depends on other writers; re-read it next time
+                user_cache.invalidate(user['id'])
+            else:
+                user_cache.update(user['id'], Database.backend().as_stored('users', sets), unsets)
+            user.mark_clean()
+            return True
+        user_cache.invalidate(user['id'])
+        return False
+
+    # =============================================
+    # ATOMIC QUOTA COUNTER
+    # =============================================
+
+    @staticmethod
+    def consume_checks(user_id, limit, amount=1):
+        """Atomically reset-if-new-day, check the free limit and count `amount` checks.
+
+        Returns (allowed, fields written) where fields holds the new checks_today
+        etc., or (False, None) when the user doesn't exist.
+        """
+        Database._count_op()
+        try:
+            allowed, fields = Database.backend().consume_checks(user_id, limit, amount, datetime.now())
+        except Exception as e:
+            user_cache.invalidate(user_id)
+            # Cached user reads skip get_db, so this may be the first call to see the outage
+            Database._check_connection_error(e)
+            raise
+        if fields:
+            user_cache.update(user_id, fields)
+        return allowed, fields
+
+    @staticmethod
+    def _quota_fields(doc, today, limit, amount):
+        """Python mirror of _quota_pipeline, applied to the pre-update document"""
+        checks = (doc.get('checks_today') or 0) if doc.get('last_check_date') == today else 0
+        premium = doc.get('is_premium') is True
+        until = as_date(doc.get('premium_until'))
+        expired = premium and until is not None and str(until) < today
+        # Premium without an end date gets the free limit, as can_make_free_check did
+        active = premium and until is not None and not expired
+        allowed = active or checks + amount <= limit
+
+        fields = {
+            'last_check_date': today,
+            'checks_today': checks + amount if allowed else checks,
+            'total_checks': (doc.get('total_checks') or 0) + (amount if allowed else 0)
+        }
+        if expired:
+            fields.update({'is_premium': False, 'premium_until': None, 'premium_plan': None})
+        return allowed, fields
+
+    # =============================================
+    # ATOMIC OTP VERIFICATION
+    # =============================================
+
+    @staticmethod
+    def verify_otp(email, otp_code, max_attempts):
+        """Check and consume an OTP in one conditional update.
+
+        A match on an unexpired code with attempts left marks it verified and
+        clears the code; a miss counts an attempt and clears the code once
+        max_attempts is reached. Returns True only for a match.
+        """
+        try:
+            Database._count_op()
+            verified, _ = Database.backend().verify_otp(email, otp_code, max_attempts, datetime.utcnow())
+            return verified
+        except Exception as e:
+            logger.error(f"Error verifying OTP for {email}: {e}")
+            Database._check_connection_error(e)
+            return False
+
+    @staticmethod
+    def _otp_fields(doc, otp_code, max_attempts, now):
+        """Python mirror of MongoBackend._otp_pipeline, applied to the pre-update document"""
+        attempts = doc.get('attempts') or 0
+        stored = doc.get('otp_code')
+        expires_at = doc.get('expires_at')
+        matched = (
+            isinstance(stored, str) and hmac.compare_digest(stored, otp_code)
+            and isinstance(expires_at, datetime) and expires_at > now
+            and attempts < max_attempts
+        )
+        if matched:
+            return True, {'verified': True, 'otp_code': None}
+        fields = {'attempts': attempts + 1}
+        if attempts + 1 >= max_attempts:
+            fields['otp_code'] = None
+        return False, fields
+
+    @staticmethod
+    def get_payment(payment_id):
+        return Database.find_one('payments', payment_id)
+
+    @staticmethod
+    def insert_payment(payment):
+        return Database.replace_one('payments', payment['id'], payment)
+
+    @staticmethod
+    def update_payment_fields(payment_id, fields):
+        return Database.update_one('payments', payment_id, fields)
+
+    @staticmethod
+    def get_session(session_token):
+        return Database.find_one('sessions', session_token)
+
+    @staticmethod
+    def insert_session(session_data):
+        return Database.replace_one('sessions', session_data['session_token'], session_data)
+
+    @staticmethod
+    def update_session_fields(session_token, fields):
+        return Database.update_one('sessions', session_token, fields)
+
+    @staticmethod
+    def delete_session(session_token):
+        return Database.delete_one('sessions', session_token)
+
+    @staticmethod
+    def get_otp(email):
+        return Database.find_one('otp_storage', email)
+
+    @staticmethod
+    def set_otp(otp_data):
+        return Database.replace_one('otp_storage', otp_data['email'], otp_data)
+
+    @staticmethod
+    def update_otp_fields(email, fields):
+        return Database.update_one('otp_storage', email, fields)
+
+    # =============================================
+    # WHOLE-COLLECTION LOAD/SAVE (admin & migrations)
+    # =============================================
+
+    BULK_CHUNK_SIZE = int(os.environ.get('DB_BULK_CHUNK_SIZE', 1000))
+
+    @staticmethod
+    def bulk_save(collection_name, docs, chunk_size=None):
+        """Upsert {doc_id: doc} in unordered batches of chunk_size each"""
+        result = BulkSaveResult()
+        try:
+            Database.backend().bulk_replace(collection_name, docs, chunk_size or Database.BULK_CHUNK_SIZE, result)
+        except Exception as e:
+            logger.error(f"Error saving {collection_name}: {e}")
+            Database._check_connection_error(e)
+            result.failed = len(docs) - result.matched - result.upserted
+            result.errors.append(str(e))
+        if collection_name == 'users':
+            # After the write, so reads that raced it are rejected too
+            user_cache.clear()
+        return result
+
+    @staticmethod
+    def bulk_update(collection_name, updates, chunk_size=None):
+        """$set {doc_id: fields} on existing documents in unordered batches; never upserts"""
+        result = BulkSaveResult()
+        try:
+            Database.backend().bulk_update(collection_name, updates, chunk_size or Database.BULK_CHUNK_SIZE, result)
+        except Exception as e:
+            logger.error(f"Error updating {collection_name}: {e}")
+            Database._check_connection_error(e)
+            result.failed = len(updates) - result.matched
+            result.errors.append(str(e))
+        if collection_name == 'users':
+            backend = Database.backend()
+            for user_id, fields in updates.items():
+                user_cache.update(user_id, backend.as_stored('users', fields))
+        return result
+
+    @staticmethod
+    def _load_all(collection_name):
+        """Every document in a collection as {doc_id: doc}"""
+        Database._count_op()
+        return Database.backend().find_all(collection_name)
+
     @staticmethod
     def load_users():
         try:
-            collection = Database.get_collection('users')
-            if isinstance(collection, dict):
-                # In-memory fallback
-                return collection
-            
-            users = {}
-            for user in collection.find():
-                user_dict = {k: v for k, v in user.items() if k != '_id'}
-                # Convert ObjectId to string
-                if '_id' in user:
-                    user_dict['id'] = str(user['_id'])
-                users[user_dict.get('id', '')] = user_dict
-            
-            logger.info(f"📥 Loaded {len(users)} users from MongoDB")
+            users = Database._load_all('users')
+            logger.info(f"📥 Loaded {len(users)} users")
             return users
             
         except Exception as e:
             logger.error(f"Error loading users: {e}")
+            Database._check_connection_error(e)
             return {}
     
     @staticmethod
-    def save_users(users):
-        try:
-            collection = Database.get_collection('users')
-            if isinstance(collection, dict):
-                # In-memory fallback
-                collection.clear()
-                collection.update(users)
-                return True
-            
-            # For MongoDB
-            for user_id, user_data in users.items():
-                # Ensure id is included
-                user_data['_id'] = user_id
-                
-                # Convert string dates to datetime
-                date_fields = ['created_at', 'last_login', 'premium_until', 'last_check_date']
-                for field in date_fields:
-                    if field in user_data and isinstance(user_data[field], str):
-                        try:
-                            user_data[field] = datetime.fromisoformat(user_data[field].replace('Z', '+00:00'))
-                        except:
-                            pass
-                
-                # Handle reset_tokens
-                if 'reset_tokens' in user_data and isinstance(user_data['reset_tokens'], str):
-                    try:
-                        user_data['reset_tokens'] = json.loads(user_data['reset_tokens'])
-                    except:
-                        user_data['reset_tokens'] = []
-                
-                # Update or insert
-                collection.replace_one({'_id': user_id}, user_data, upsert=True)
-            
-            logger.info(f"💾 Saved {len(users)} users to MongoDB")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error saving users: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            return False
+    def save_users(users, chunk_size=None):
+        result = Database.bulk_save('users', users, chunk_size)
+        logger.info(f"💾 Saved users: {result.to_dict()}")
+        return result
     
     # Similar simplified versions for other load/save methods
     @staticmethod
     def load_payments():
         try:
-            collection = Database.get_collection('payments')
-            if isinstance(collection, dict):
-                return collection
-            
-            payments = {}
-            for payment in collection.find():
-                payment_dict = {k: v for k, v in payment.items() if k != '_id'}
-                if '_id' in payment:
-                    payment_dict['id'] = str(payment['_id'])
-                payments[payment_dict.get('id', '')] = payment_dict
-            
-            return payments
-            
+            return Database._load_all('payments')
         except Exception as e:
             logger.error(f"Error loading payments: {e}")
+            Database._check_connection_error(e)
             return {}
     
     @staticmethod
-    def save_payments(payments):
-        try:
-            collection = Database.get_collection('payments')
-            if isinstance(collection, dict):
-                collection.clear()
-                collection.update(payments)
-                return True
-            
-            for payment_id, payment_data in payments.items():
-                payment_data['_id'] = payment_id
-                collection.replace_one({'_id': payment_id}, payment_data, upsert=True)
-            
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error saving payments: {e}")
-            return False
-    
+    def save_payments(payments, chunk_size=None):
+        return Database.bulk_save('payments', payments, chunk_size)
+
     @staticmethod
     def load_sessions():
         try:
-            collection = Database.get_collection('sessions')
-            if isinstance(collection, dict):
-                return collection
-            
-            sessions = {}
-            for session in collection.find():
-                session_dict = {k: v for k, v in session.items() if k != '_id'}
-                sessions[session_dict.get('session_token', '')] = session_dict
-            
-            return sessions
-            
+            return Database._load_all('sessions')
         except Exception as e:
             logger.error(f"Error loading sessions: {e}")
+            Database._check_connection_error(e)
             return {}
     
     @staticmethod
-    def save_sessions(sessions):
-        try:
-            collection = Database.get_collection('sessions')
-            if isinstance(collection, dict):
-                collection.clear()
-                collection.update(sessions)
-                return True
-            
-            for session_token, session_data in sessions.items():
-                session_data['_id'] = session_token
-                collection.replace_one({'_id': session_token}, session_data, upsert=True)
-            
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error saving sessions: {e}")
-            return False
-    
+    def save_sessions(sessions, chunk_size=None):
+        return Database.bulk_save('sessions', sessions, chunk_size)
+
     @staticmethod
     def load_otp_storage():
         try:
-            collection = Database.get_collection('otp_storage')
-            if isinstance(collection, dict):
-                return collection
-            
-            otp_storage = {}
-            for otp in collection.find():
-                otp_dict = {k: v for k, v in otp.items() if k != '_id'}
-                otp_storage[otp_dict.get('email', '')] = otp_dict
-            
-            return otp_storage
-            
+            return Database._load_all('otp_storage')
         except Exception as e:
             logger.error(f"Error loading OTP storage: {e}")
+            Database._check_connection_error(e)
             return {}
     
     @staticmethod
-    def save_otp_storage(otp_storage):
+    def save_otp_storage(otp_storage, chunk_size=None):
+        return Database.bulk_save('otp_storage', otp_storage, chunk_size)
+
+    @staticmethod
+    def get_reset_token(token_hash):
+        return Database.find_one('reset_tokens', token_hash)
+
+    @staticmethod
+    def insert_reset_token(token_data):
+        return Database.replace_one('reset_tokens', token_data['token_hash'], token_data)
+
+    @staticmethod
+    def claim_reset_token(token_hash):
+        """Mark an unused token used in one step; returns it as it was, or None"""
+        return Database.find_one_and_update(
+            'reset_tokens', token_hash, {'used': False}, {'used': True, 'used_at': datetime.utcnow()}
+        )
+
+    @staticmethod
+    def get_outbox_message(message_id):
+        return Database.find_one('email_outbox', message_id)
+
+    @staticmethod
+    def insert_outbox_message(message):
+        return Database.replace_one('email_outbox', message['message_id'], message)
+
+    @staticmethod
+    def load_revoked_sessions():
         try:
-            collection = Database.get_collection('otp_storage')
-            if isinstance(collection, dict):
-                collection.clear()
-                collection.update(otp_storage)
-                return True
-            
-            for email, otp_data in otp_storage.items():
-                otp_data['_id'] = email
-                collection.replace_one({'_id': email}, otp_data, upsert=True)
-            
-            return True
-            
+            return Database._load_all('revoked_sessions')
         except Exception as e:
-            logger.error(f"Error saving OTP storage: {e}")
-            return False
+            logger.error(f"Error loading revoked sessions: {e}")
+            Database._check_connection_error(e)
+            return {}
+
+# =============================================
+# USER CACHE
+# =============================================
+
+class UserCache:
+    """Bounded, TTL'd LRU of user documents in front of Database's user lookups.
+
+    Every user write bumps a generation counter. A fill stamped with a generation
+    older than the last write to that user is dropped, so a read that raced a
+    write can never put the stale document back.
+    """
+
+    def __init__(self, max_size=1000, ttl=30, enabled=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()  # user_id -> (doc, expires_at)
+        self._emails = {}              # email -> user_id, for cached entries only
+        self._written = OrderedDict()  # user_id -> generation of its last write
+        self._floor = 0                # writes at or below this generation may have been forgotten
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def version(self):
+        """Stamp to take before a database read and hand to fill()"""
+        with self._lock:
+            return self._generation
+
+    def get(self, user_id):
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._lookup(user_id)
+
+    def get_by_email(self, email):
+        if not self.enabled:
+            return None
+        with self._lock:
+            user_id = self._emails.get(email)
+            if user_id is None:
+                self.misses += 1
+                return None
+            return self._lookup(user_id)
+
+    def _lookup(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                self._drop(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        # Callers may mutate nested values in place, so hand out a copy
+        return copy.deepcopy(entry[0])
+
+    def fill(self, doc, version):
+        """Cache a freshly read document unless a write to it landed after `version`"""
+        if not self.enabled or not doc or not doc.get('id'):
+            return
+        user_id = doc['id']
+        with self._lock:
+            written = self._written.get(user_id)
+            if version < (written if written is not None else self._floor):
+                return
+            self._store(user_id, copy.deepcopy(dict(doc)), time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget_email(evicted)
+                self.evictions += 1
+
+    def update(self, user_id, fields, unset=()):
+        """Apply a write whose resulting values are known to the cached copy"""
+        with self._lock:
+            self._bump(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            doc = entry[0]
+            doc.update(copy.deepcopy(fields))
+            for field in unset:
+                doc.pop(field, None)
+            self._store(user_id, doc, entry[1])
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._bump(user_id)
+            if user_id in self._entries:
+                self._drop(user_id)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._written.clear()
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._emails.clear()
+
+    def _store(self, user_id, doc, expires_at):
+        self._forget_email(user_id)
+        self._entries[user_id] = (doc, expires_at)
+        self._entries.move_to_end(user_id)
+        if doc.get('email'):
+            self._emails[doc['email']] = user_id
+
+    def _drop(self, user_id):
+        self._forget_email(user_id)
+        self._entries.pop(user_id, None)
+
+    def _forget_email(self, user_id):
+        entry = self._entries.get(user_id)
+        email = entry[0].get('email') if entry else None
+        if email and self._emails.get(email) == user_id:
+            del self._emails[email]
+
+    def _bump(self, user_id):
+        self._generation += 1
+        self._written[user_id] = self._generation
+        self._written.move_to_end(user_id)
+        # Keep the write log bounded; forgotten writes raise the floor instead
+        while len(self._written) > 4 * self.max_size:
+            _, generation = self._written.popitem(last=False)
+            self._floor = max(self._floor, generation)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None
+        }
+
+user_cache = UserCache(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 1000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL_SECONDS', 30)),
+    enabled=os.environ.get('USER_CACHE_ENABLED', 'true').lower() == 'true'
+)
+
+# =============================================
+# WRITE-BEHIND TOUCHES
+# =============================================
+
+class TouchBuffer:
+    """Coalesces last_active / last_accessed stamps and writes them in one bulk update per interval.
+
+    Only the newest value per (collection, doc_id, field) is kept. The buffer is
+    process-local, so a crash loses at most one interval of timestamps.
+    """
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._pending = {}  # collection -> {doc_id: {field: value}}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.touches = 0
+        self.flushed = 0
+        self.last_flush_at = None
+
+    def touch(self, collection_name, doc_id, field, value):
+        if self.interval <= 0:
+            # Buffering disabled: write through
+            return Database.update_one(collection_name, doc_id, {field: value})
+        with self._lock:
+            fields = self._pending.setdefault(collection_name, {}).setdefault(doc_id, {})
+            if field not in fields or fields[field] < value:
+                fields[field] = value
+            self.touches += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Touch flush failed: {e}")
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for collection_name, updates in pending.items():
+            result = Database.bulk_update(collection_name, updates)
+            self.flushed += result.matched
+            if not result:
+                logger.warning(f"⚠️ Dropped {result.failed} {collection_name} touches: {result.errors[:3]}")
+        if pending:
+            self.last_flush_at = datetime.now()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(updates) for updates in self._pending.values())
+
+    def stats(self):
+        return {
+            'interval_seconds': self.interval,
+            'pending': self.pending(),
+            'touches': self.touches,
+            'flushed': self.flushed,
+            'last_flush_at': self.last_flush_at.isoformat() if self.last_flush_at else None
+        }
+
+touch_buffer = TouchBuffer(interval=float(os.environ.get('TOUCH_FLUSH_SECONDS', 30)))
+
+# =============================================
+# STORAGE BACKENDS
+# =============================================
+
+class StorageBackend:
+    """Document store behind Database; documents go in and come out without _id"""
+
+    name = None
+
+    def find_one(self, collection_name, doc_id):
+        raise NotImplementedError
+
+    def find_one_by(self, collection_name, field, value):
+        raise NotImplementedError
+
+    def find_all(self, collection_name):
+        """Every document as {doc_id: doc}"""
+        raise NotImplementedError
+
+    def find_by(self, collection_name, field, value, limit, before=None):
+        raise NotImplementedError
+
+    def count(self, collection_name):
+        raise NotImplementedError
+
+    def insert_one(self, collection_name, doc_id, doc):
+        """Raises DuplicateKeyError on a unique index violation"""
+        raise NotImplementedError
+
+    def replace_one(self, collection_name, doc_id, doc):
+        raise NotImplementedError
+
+    def update_one(self, collection_name, doc_id, fields, upsert=False, inc=None, unset=None):
+        raise NotImplementedError
+
+    def delete_one(self, collection_name, doc_id):
+        raise NotImplementedError
+
+    def find_one_and_update(self, collection_name, doc_id, match, fields=None, inc=None):
+        """Apply $set/$inc only if the document's fields equal `match`; returns the pre-image or None"""
+        raise NotImplementedError
+
+    def bulk_replace(self, collection_name, docs, chunk_size, result):
+        """Upsert {doc_id: doc}, tallying into the given BulkSaveResult"""
+        raise NotImplementedError
+
+    def bulk_update(self, collection_name, updates, chunk_size, result):
+        """$set {doc_id: fields} on documents that exist, tallying into the given BulkSaveResult"""
+        raise NotImplementedError
+
+    def consume_checks(self, user_id, limit, amount, now):
+        """See Database.consume_checks"""
+        raise NotImplementedError
+
+    def verify_otp(self, email, otp_code, max_attempts, now):
+        """See Database.verify_otp; returns (verified, fields written)"""
+        raise NotImplementedError
+
+    def as_stored(self, collection_name, fields):
+        """The values a later read returns for `fields` once they are written"""
+        return fields
+
+    def migrate(self):
+        pass
+
+    def schema_version(self):
+        return None
+
+    def index_status(self):
+        return {}
+
+    @staticmethod
+    def quota_day(now):
+        return str(now.date()), datetime.combine(now.date(), datetime.min.time())
+
+class MongoBackend(StorageBackend):
+    """MongoDB / Atlas; the default"""
+
+    name = 'mongodb'
+
+    # Collections whose documents expose their _id as an 'id' field
+    _ID_FIELDS = {'users': 'id', 'payments': 'id'}
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def _from_document(collection_name, doc):
+        """Strip Mongo's _id and restore the public id field"""
+        if doc is None:
+            return None
+        result = {k: v for k, v in doc.items() if k != '_id'}
+        id_field = MongoBackend._ID_FIELDS.get(collection_name)
+        if id_field and '_id' in doc:
+            result[id_field] = str(doc['_id'])
+        return result
+
+    @staticmethod
+    def _to_document(collection_name, fields):
+        """Convert user date strings and reset_tokens to their stored types, for the given fields only"""
+        fields = {k: v for k, v in fields.items() if k != '_id'}
+        if collection_name != 'users':
+            return fields
+
+        # last_check_date stays a 'YYYY-MM-DD' string so the quota pipeline can compare it
+        for field in ('created_at', 'last_login', 'premium_until'):
+            if field in fields and isinstance(fields[field], str):
+                try:
+                    fields[field] = datetime.fromisoformat(fields[field].replace('Z', '+00:00'))
+                except:
+                    pass
+
+        if 'reset_tokens' in fields and isinstance(fields['reset_tokens'], str):
+            try:
+                fields['reset_tokens'] = json.loads(fields['reset_tokens'])
+            except:
+                fields['reset_tokens'] = []
+        return fields
+
+    def as_stored(self, collection_name, fields):
+        fields = self._to_document(collection_name, fields)
+        # BSON dates are millisecond precision and come back as naive UTC
+        for key, value in fields.items():
+            if isinstance(value, datetime):
+                if value.tzinfo is not None:
+                    value = value.astimezone(timezone.utc).replace(tzinfo=None)
+                fields[key] = value.replace(microsecond=value.microsecond // 1000 * 1000)
+        return fields
+
+    def find_one(self, collection_name, doc_id):
+        return self._from_document(collection_name, self.db[collection_name].find_one({'_id': doc_id}))
+
+    def find_one_by(self, collection_name, field, value):
+        return self._from_document(collection_name, self.db[collection_name].find_one({field: value}))
+
+    def find_all(self, collection_name):
+        return {
+            str(doc['_id']): self._from_document(collection_name, doc)
+            for doc in self.db[collection_name].find()
+        }
+
+    def find_by(self, collection_name, field, value, limit, before=None):
+        query = {field: value}
+        if before:
+            query[before[0]] = {'$lte': before[1]}
+        cursor = self.db[collection_name].find(query)
+        if before:
+            cursor = cursor.sort(before[0], ASCENDING)
+        return [self._from_document(collection_name, doc) for doc in cursor.limit(limit)]
+
+    def count(self, collection_name):
+        return self.db[collection_name].estimated_document_count()
+
+    def insert_one(self, collection_name, doc_id, doc):
+        doc = self._to_document(collection_name, doc)
+        doc['_id'] = doc_id
+        self.db[collection_name].insert_one(doc)
+        return True
+
+    def replace_one(self, collection_name, doc_id, doc):
+        doc = self._to_document(collection_name, doc)
+        doc['_id'] = doc_id
+        self.db[collection_name].replace_one({'_id': doc_id}, doc, upsert=True)
+        return True
+
+    def update_one(self, collection_name, doc_id, fields, upsert=False, inc=None, unset=None):
+        update = {}
+        if fields:
+            update['$set'] = self._to_document(collection_name, fields)
+        if inc:
+            update['$inc'] = dict(inc)
+        if unset:
+            update['$unset'] = {field: '' for field in unset}
+        if not update:
+            return True
+        result = self.db[collection_name].update_one({'_id': doc_id}, update, upsert=upsert)
+        return result.matched_count > 0 or result.upserted_id is not None
+
+    def delete_one(self, collection_name, doc_id):
+        return self.db[collection_name].delete_one({'_id': doc_id}).deleted_count > 0
+
+    def find_one_and_update(self, collection_name, doc_id, match, fields=None, inc=None):
+        update = {}
+        if fields:
+            update['$set'] = self._to_document(collection_name, fields)
+        if inc:
+            update['$inc'] = dict(inc)
+        before = self.db[collection_name].find_one_and_update(
+            {**match, '_id': doc_id}, update, return_document=ReturnDocument.BEFORE
+        )
+        return self._from_document(collection_name, before)
+
+    def bulk_replace(self, collection_name, docs, chunk_size, result):
+        collection = self.db[collection_name]
+        operations = []
+        for doc_id, doc in docs.items():
+            document = self._to_document(collection_name, doc)
+            document['_id'] = doc_id
+            operations.append(ReplaceOne({'_id': doc_id}, document, upsert=True))
+            if len(operations) >= chunk_size:
+                self._flush_bulk(collection, operations, result)
+                operations = []
+        if operations:
+            self._flush_bulk(collection, operations, result)
+
+    def bulk_update(self, collection_name, updates, chunk_size, result):
+        collection = self.db[collection_name]
+        operations = [
+            UpdateOne({'_id': doc_id}, {'$set': self._to_document(collection_name, fields)})
+            for doc_id, fields in updates.items()
+        ]
+        for start in range(0, len(operations), chunk_size):
+            self._flush_bulk(collection, operations[start:start + chunk_size], result)
+
+    @staticmethod
+    def _flush_bulk(collection, operations, result):
+        Database._count_op()
+        try:
+            outcome = collection.bulk_write(operations, ordered=False)
+            result.add(outcome.matched_count, outcome.upserted_count)
+        except BulkWriteError as e:
+            details = e.details
+            result.add(details.get('nMatched', 0), details.get('nUpserted', 0))
+            result.failed += len(details.get('writeErrors', []))
+            result.errors.extend(error.get('errmsg', '') for error in details.get('writeErrors', []))
+
+    def consume_checks(self, user_id, limit, amount, now):
+        today, today_start = self.quota_day(now)
+        # One round trip; the pre-image tells us exactly what the pipeline decided
+        before = self.db['users'].find_one_and_update(
+            {'_id': user_id},
+            self._quota_pipeline(today, today_start, limit, amount),
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            return False, None
+        return Database._quota_fields(before, today, limit, amount)
+
+    @staticmethod
+    def _quota_pipeline(today, today_start, limit, amount):
+        checks = {'$cond': [{'$eq': ['$last_check_date', today]}, {'$ifNull': ['$checks_today', 0]}, 0]}
+        until = {'$convert': {'input': '$premium_until', 'to': 'date', 'onError': None, 'onNull': None}}
+        premium = {'$eq': ['$is_premium', True]}
+        return [
+            {'$set': {
+                '_quota_checks': checks,
+                '_quota_expired': {'$and': [premium, {'$ne': [until, None]}, {'$lt': [until, today_start]}]},
+                '_quota_active': {'$and': [premium, {'$ne': [until, None]}, {'$gte': [until, today_start]}]}
+            }},
+            {'$set': {
+                '_quota_allowed': {'$or': [
+                    '$_quota_active',
+                    {'$lte': [{'$add': ['$_quota_checks', amount]}, limit]}
+                ]}
+            }},
+            {'$set': {
+                'last_check_date': today,
+                'checks_today': {'$cond': ['$_quota_allowed', {'$add': ['$_quota_checks', amount]}, '$_quota_checks']},
+                'total_checks': {'$add': [{'$ifNull': ['$total_checks', 0]}, {'$cond': ['$_quota_allowed', amount, 0]}]},
+                'is_premium': {'$cond': ['$_quota_expired', False, '$is_premium']},
+                'premium_until': {'$cond': ['$_quota_expired', None, '$premium_until']},
+                'premium_plan': {'$cond': ['$_quota_expired', None, '$premium_plan']}
+            }},
+            {'$unset': ['_quota_checks', '_quota_expired', '_quota_active', '_quota_allowed']}
+        ]
+
+    def verify_otp(self, email, otp_code, max_attempts, now):
+        before = self.db['otp_storage'].find_one_and_update(
+            {'_id': email},
+            self._otp_pipeline(otp_code, max_attempts, now),
+            return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            return False, None
+        return Database._otp_fields(before, otp_code, max_attempts, now)
+
+    @staticmethod
+    def _otp_pipeline(otp_code, max_attempts, now):
+        attempts = {'$ifNull': ['$attempts', 0]}
+        return [
+            {'$set': {
+                '_otp_ok': {'$and': [
+                    {'$eq': ['$otp_code', otp_code]},
+                    {'$eq': [{'$type': '$expires_at'}, 'date']},
+                    {'$gt': ['$expires_at', now]},
+                    {'$lt': [attempts, max_attempts]}
+                ]}
+            }},
+            {'$set': {
+                'verified': {'$cond': ['$_otp_ok', True, '$verified']},
+                'attempts': {'$cond': ['$_otp_ok', '$attempts', {'$add': [attempts, 1]}]},
+                'otp_code': {'$cond': [
+                    {'$or': ['$_otp_ok', {'$gte': [{'$add': [attempts, 1]}, max_attempts]}]},
+                    None,
+                    '$otp_code'
+                ]}
+            }},
+            {'$unset': ['_otp_ok']}
+        ]
+
+    def migrate(self):
+        Database.migrate(self.db)
+
+    def schema_version(self):
+        return Database.schema_version(self.db)
+
+    def index_status(self):
+        return Database.index_status(self.db)
+
+class MemoryBackend(StorageBackend):
+    """Process-local dicts; the fallback while MongoDB is unreachable, and for tests"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self.storage = {collection: {} for collection in Database.COLLECTIONS}
+        self.expiry = ExpiryHeap()
+        self.lock = threading.RLock()
+
+    def _collection(self, collection_name):
+        # Callers hold self.lock: the purge and every read/write below mutate or walk these dicts
+        self.expiry.purge(self.storage)
+        return self.storage.setdefault(collection_name, {})
+
+    def _track_expiry(self, collection_name, doc_id, doc):
+        """Schedule lazy deletion of a document in a TTL collection"""
+        field = Database.ttl_field(collection_name)
+        if field and isinstance(doc.get(field), datetime):
+            self.expiry.schedule(collection_name, doc_id, field, doc[field])
+
+    def find_one(self, collection_name, doc_id):
+        with self.lock:
+            doc = self._collection(collection_name).get(doc_id)
+            return dict(doc) if doc is not None else None
+
+    def find_one_by(self, collection_name, field, value):
+        with self.lock:
+            for doc in self._collection(collection_name).values():
+                if doc.get(field) == value:
+                    return dict(doc)
+        return None
+
+    def find_all(self, collection_name):
+        with self.lock:
+            return {doc_id: dict(doc) for doc_id, doc in self._collection(collection_name).items()}
+
+    def find_by(self, collection_name, field, value, limit, before=None):
+        with self.lock:
+            docs = [dict(doc) for doc in self._collection(collection_name).values() if doc.get(field) == value]
+        if before:
+            due_field, cutoff = before
+            docs = sorted(
+                (doc for doc in docs if isinstance(doc.get(due_field), datetime) and doc[due_field] <= cutoff),
+                key=lambda doc: doc[due_field]
+            )
+        return docs[:limit]
+
+    def count(self, collection_name):
+        with self.lock:
+            return len(self._collection(collection_name))
+
+    def insert_one(self, collection_name, doc_id, doc):
+        with self.lock:
+            collection = self._collection(collection_name)
+            # Emulate the unique indexes
+            if doc_id in collection:
+                raise DuplicateKeyError(f"duplicate _id: {doc_id}", 11000, {'keyPattern': {'_id': 1}})
+            for field in Database._unique_fields(collection_name):
+                value = doc.get(field)
+                if value is not None and any(d.get(field) == value for d in collection.values()):
+                    raise DuplicateKeyError(f"duplicate {field}: {value}", 11000, {'keyPattern': {field: 1}})
+            collection[doc_id] = dict(doc)
+            self._track_expiry(collection_name, doc_id, doc)
+            return True
+
+    def replace_one(self, collection_name, doc_id, doc):
+        with self.lock:
+            self._collection(collection_name)[doc_id] = dict(doc)
+            self._track_expiry(collection_name, doc_id, doc)
+            return True
+
+    def update_one(self, collection_name, doc_id, fields, upsert=False, inc=None, unset=None):
+        with self.lock:
+            collection = self._collection(collection_name)
+            if doc_id not in collection:
+                if not upsert:
+                    return False
+                collection[doc_id] = {}
+            doc = collection[doc_id]
+            doc.update(fields)
+            for field, amount in (inc or {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            for field in unset or ():
+                doc.pop(field, None)
+            self._track_expiry(collection_name, doc_id, doc)
+            return True
+
+    def delete_one(self, collection_name, doc_id):
+        with self.lock:
+            return self._collection(collection_name).pop(doc_id, None) is not None
+
+    def find_one_and_update(self, collection_name, doc_id, match, fields=None, inc=None):
+        with self.lock:
+            doc = self._collection(collection_name).get(doc_id)
+            if doc is None or any(doc.get(field) != value for field, value in match.items()):
+                return None
+            before = dict(doc)
+            doc.update(fields or {})
+            for field, amount in (inc or {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            self._track_expiry(collection_name, doc_id, doc)
+            return before
+
+    def bulk_replace(self, collection_name, docs, chunk_size, result):
+        with self.lock:
+            collection = self._collection(collection_name)
+            result.matched = sum(1 for doc_id in docs if doc_id in collection)
+            result.upserted = len(docs) - result.matched
+            for doc_id, doc in docs.items():
+                collection[doc_id] = dict(doc)
+                self._track_expiry(collection_name, doc_id, doc)
+
+    def bulk_update(self, collection_name, updates, chunk_size, result):
+        with self.lock:
+            collection = self._collection(collection_name)
+            for doc_id, fields in updates.items():
+                if doc_id in collection:
+                    collection[doc_id].update(fields)
+                    self._track_expiry(collection_name, doc_id, collection[doc_id])
+                    result.add(1, 0)
+
+    def consume_checks(self, user_id, limit, amount, now):
+        today, _ = self.quota_day(now)
+        with self.lock:
+            doc = self._collection('users').get(user_id)
+            if doc is None:
+                return False, None
+            allowed, fields = Database._quota_fields(doc, today, limit, amount)
+            doc.update(fields)
+            return allowed, fields
+
+    def verify_otp(self, email, otp_code, max_attempts, now):
+        with self.lock:
+            doc = self._collection('otp_storage').get(email)
+            if doc is None:
+                return False, None
+            verified, fields = Database._otp_fields(doc, otp_code, max_attempts, now)
+            doc.update(fields)
+            return verified, fields
+
+class SQLiteBackend(StorageBackend):
+    """Embedded single-node store: one WAL-mode SQLite file, one table per collection.
+
+    Each row keeps the document as JSON plus a real column for every field named
+    in Database.INDEXES, so lookups, the unique email and TTL sweeps use indexes.
+    """
+
+    name = 'sqlite'
+    PURGE_INTERVAL = 60  # seconds, like MongoDB's TTL monitor
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_PATH
+        self._local = threading.local()
+        self._purged_at = {}
+        if self.schema_version() != Database.SCHEMA_VERSION:
+            self.migrate()
+        logger.info(f"✅ Using SQLite storage: {self.path}")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit; writes open their own BEGIN IMMEDIATE transaction
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    # ---- schema ----
+
+    @staticmethod
+    def _columns(collection_name):
+        """Indexed fields that get a real column next to the JSON document"""
+        columns = []
+        for index in Database.INDEXES.get(collection_name, []):
+            for field, _ in index['keys']:
+                if field not in columns:
+                    columns.append(field)
+        return columns
+
+    def migrate(self):
+        """Create tables, columns and indexes, then record SCHEMA_VERSION (idempotent)"""
+        with self._transaction() as conn:
+            for collection_name in Database.COLLECTIONS:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {collection_name} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+                existing = {row[1] for row in conn.execute(f'PRAGMA table_info({collection_name})')}
+                missing = [column for column in self._columns(collection_name) if column not in existing]
+                for column in missing:
+                    conn.execute(f'ALTER TABLE {collection_name} ADD COLUMN {column}')
+                if missing:
+                    # Backfill new columns from the stored documents
+                    for doc_id, raw in conn.execute(f'SELECT id, doc FROM {collection_name}').fetchall():
+                        self._write_columns(conn, collection_name, doc_id, self._decode(raw))
+
+                for index in Database.INDEXES.get(collection_name, []):
+                    columns = ', '.join(field for field, _ in index['keys'])
+                    unique = 'UNIQUE ' if index.get('unique') else ''
+                    where = f" WHERE {index['keys'][0][0]} IS NOT NULL" if 'partialFilterExpression' in index else ''
+                    conn.execute(
+                        f"CREATE {unique}INDEX IF NOT EXISTS {collection_name}_{index['name']} "
+                        f"ON {collection_name} ({columns}){where}"
+                    )
+            conn.execute(f'PRAGMA user_version = {int(Database.SCHEMA_VERSION)}')
+        logger.info(f"🗂️ SQLite schema at version {Database.SCHEMA_VERSION}")
+
+    def schema_version(self):
+        version = self._conn().execute('PRAGMA user_version').fetchone()[0]
+        return version or None
+
+    def index_status(self):
+        status = {}
+        for collection_name, indexes in Database.INDEXES.items():
+            existing = {row[1] for row in self._conn().execute(f'PRAGMA index_list({collection_name})')}
+            status[collection_name] = {
+                index['name']: f"{collection_name}_{index['name']}" in existing for index in indexes
+            }
+        return status
+
+    # ---- encoding ----
+
+    @staticmethod
+    def _encode(doc):
+        def default(value):
+            if isinstance(value, datetime):
+                return {'$date': value.isoformat()}
+            return str(value)
+        return json.dumps({k: v for k, v in doc.items() if k != '_id'}, default=default)
+
+    @staticmethod
+    def _decode(raw):
+        def hook(obj):
+            if len(obj) == 1 and '$date' in obj:
+                return datetime.fromisoformat(obj['$date'])
+            return obj
+        return json.loads(raw, object_hook=hook)
+
+    def as_stored(self, collection_name, fields):
+        return self._decode(self._encode(fields))
+
+    @staticmethod
+    def _column_value(value):
+        """Datetimes become epoch seconds (UTC) so TTL sweeps compare numbers"""
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                return value.timestamp()
+            return (value - datetime(1970, 1, 1)).total_seconds()
+        if isinstance(value, (str, int, float)):
+            return value
+        return None
+
+    def _row(self, collection_name, doc_id, doc):
+        columns = self._columns(collection_name)
+        values = [doc_id, self._encode(doc)] + [self._column_value(doc.get(column)) for column in columns]
+        return ['id', 'doc'] + columns, values
+
+    def _write_columns(self, conn, collection_name, doc_id, doc):
+        columns = self._columns(collection_name)
+        if columns:
+            assignments = ', '.join(f'{column} = ?' for column in columns)
+            conn.execute(
+                f'UPDATE {collection_name} SET {assignments} WHERE id = ?',
+                [self._column_value(doc.get(column)) for column in columns] + [doc_id]
+            )
+
+    @staticmethod
+    def _duplicate_key(e, collection_name):
+        """Map 'UNIQUE constraint failed: users.email' onto pymongo's DuplicateKeyError"""
+        field = str(e).rsplit('.', 1)[-1].strip()
+        field = '_id' if field == 'id' else field
+        return DuplicateKeyError(f"duplicate {field} in {collection_name}", 11000, {'keyPattern': {field: 1}})
+
+    def _upsert(self, conn, collection_name, doc_id, doc):
+        names, values = self._row(collection_name, doc_id, doc)
+        updates = ', '.join(f'{name} = excluded.{name}' for name in names[1:])
+        conn.execute(
+            f"INSERT INTO {collection_name} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}",
+            values
+        )
+
+    def _get(self, conn, collection_name, doc_id):
+        row = conn.execute(f'SELECT doc FROM {collection_name} WHERE id = ?', (doc_id,)).fetchone()
+        return self._decode(row[0]) if row else None
+
+    # ---- TTL ----
+
+    def _purge_expired(self, collection_name):
+        field = Database.ttl_field(collection_name)
+        if not field or time.time() - self._purged_at.get(collection_name, 0) < self.PURGE_INTERVAL:
+            return
+        self._purged_at[collection_name] = time.time()
+        now = self._column_value(datetime.utcnow())
+        # Legacy string values sort after numbers in SQLite, so like MongoDB they never expire
+        deleted = self._conn().execute(
+            f'DELETE FROM {collection_name} WHERE {field} <= ?', (now,)
+        ).rowcount
+        if deleted:
+            logger.info(f"🧹 Expired {deleted} {collection_name} documents")
+
+    # ---- operations ----
+
+    def find_one(self, collection_name, doc_id):
+        self._purge_expired(collection_name)
+        return self._get(self._conn(), collection_name, doc_id)
+
+    def find_one_by(self, collection_name, field, value):
+        docs = self.find_by(collection_name, field, value, 1)
+        return docs[0] if docs else None
+
+    def find_by(self, collection_name, field, value, limit, before=None):
+        self._purge_expired(collection_name)
+        columns = self._columns(collection_name)
+        if field in columns:
+            where, params = f'{field} = ?', [self._column_value(value)]
+        else:
+            where, params = "json_extract(doc, '$.' || ?) = ?", [field, value]
+        if before and before[0] in columns:
+            where += f' AND {before[0]} <= ? ORDER BY {before[0]}'
+            params.append(self._column_value(before[1]))
+        elif before:
+            raise ValueError(f"{collection_name}.{before[0]} is not an indexed column")
+        rows = self._conn().execute(f'SELECT doc FROM {collection_name} WHERE {where} LIMIT ?', params + [limit])
+        return [self._decode(raw) for raw, in rows]
+
+    def find_all(self, collection_name):
+        self._purge_expired(collection_name)
+        rows = self._conn().execute(f'SELECT id, doc FROM {collection_name}')
+        return {doc_id: self._decode(raw) for doc_id, raw in rows}
+
+    def count(self, collection_name):
+        self._purge_expired(collection_name)
+        return self._conn().execute(f'SELECT COUNT(*) FROM {collection_name}').fetchone()[0]
+
+    def insert_one(self, collection_name, doc_id, doc):
+        names, values = self._row(collection_name, doc_id, doc)
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    f"INSERT INTO {collection_name} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                    values
+                )
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate_key(e, collection_name)
+        return True
+
+    def replace_one(self, collection_name, doc_id, doc):
+        with self._transaction() as conn:
+            self._upsert(conn, collection_name, doc_id, doc)
+        return True
+
+    def update_one(self, collection_name, doc_id, fields, upsert=False, inc=None, unset=None):
+        with self._transaction() as conn:
+            doc = self._get(conn, collection_name, doc_id)
+            if doc is None:
+                if not upsert:
+                    return False
+                doc = {}
+            doc.update(fields)
+            for field, amount in (inc or {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            for field in unset or ():
+                doc.pop(field, None)
+            self._upsert(conn, collection_name, doc_id, doc)
+        return True
+
+    def delete_one(self, collection_name, doc_id):
+        with self._transaction() as conn:
+            return conn.execute(f'DELETE FROM {collection_name} WHERE id = ?', (doc_id,)).rowcount > 0
+
+    def find_one_and_update(self, collection_name, doc_id, match, fields=None, inc=None):
+        with self._transaction() as conn:
+            doc = self._get(conn, collection_name, doc_id)
+            if doc is None or any(doc.get(field) != value for field, value in match.items()):
+                return None
+            before = dict(doc)
+            doc.update(fields or {})
+            for field, amount in (inc or {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            self._upsert(conn, collection_name, doc_id, doc)
+            return before
+
+    def bulk_replace(self, collection_name, docs, chunk_size, result):
+        items = list(docs.items())
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            Database._count_op()
+            # One transaction per chunk; like an unordered bulk_write a bad row doesn't stop the rest
+            with self._transaction() as conn:
+                placeholders = ', '.join('?' for _ in chunk)
+                existing = {row[0] for row in conn.execute(
+                    f'SELECT id FROM {collection_name} WHERE id IN ({placeholders})', [doc_id for doc_id, _ in chunk]
+                )}
+                for doc_id, doc in chunk:
+                    try:
+                        self._upsert(conn, collection_name, doc_id, doc)
+                    except sqlite3.IntegrityError as e:
+                        result.failed += 1
+                        result.errors.append(f"{doc_id}: {e}")
+                        continue
+                    if doc_id in existing:
+                        result.add(1, 0)
+                    else:
+                        result.add(0, 1)
+
+    def bulk_update(self, collection_name, updates, chunk_size, result):
+        items = list(updates.items())
+        for start in range(0, len(items), chunk_size):
+            Database._count_op()
+            with self._transaction() as conn:
+                for doc_id, fields in items[start:start + chunk_size]:
+                    doc = self._get(conn, collection_name, doc_id)
+                    if doc is None:
+                        continue
+                    doc.update(fields)
+                    self._upsert(conn, collection_name, doc_id, doc)
+                    result.add(1, 0)
+
+    def consume_checks(self, user_id, limit, amount, now):
+        today, _ = self.quota_day(now)
+        # BEGIN IMMEDIATE takes the write lock first, so concurrent checks serialize
+        with self._transaction() as conn:
+            doc = self._get(conn, 'users', user_id)
+            if doc is None:
+                return False, None
+            allowed, fields = Database._quota_fields(doc, today, limit, amount)
+            doc.update(fields)
+            self._upsert(conn, 'users', user_id, doc)
+            return allowed, fields
+
+    def verify_otp(self, email, otp_code, max_attempts, now):
+        with self._transaction() as conn:
+            doc = self._get(conn, 'otp_storage', email)
+            if doc is None:
+                return False, None
+            verified, fields = Database._otp_fields(doc, otp_code, max_attempts, now)
+            doc.update(fields)
+            self._upsert(conn, 'otp_storage', email, doc)
+            return verified, fields
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class ExpiryHeap:
+    """Heap of (deadline, collection, key) giving the in-memory fallback TTL semantics.
+
+    Each key has at most one live entry, so repeated updates (e.g. session
+    touches) don't grow the heap. A later deadline leaves the entry alone and is
+    re-armed when it fires; an earlier one supersedes it, and the stale entry is
+    skipped when popped.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {}  # (collection, key) -> deadline of its live heap entry
+        self._lock = threading.Lock()
+
+    def schedule(self, collection_name, doc_id, field, deadline):
+        key = (collection_name, doc_id)
+        with self._lock:
+            current = self._scheduled.get(key)
+            if current is not None and current <= deadline:
+                return
+            self._scheduled[key] = deadline
+            heapq.heappush(self._heap, (deadline, collection_name, doc_id, field))
+
+    def purge(self, storage, now=None):
+        """Drop documents whose deadline passed; only due entries are touched"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, collection_name, doc_id, field = heapq.heappop(self._heap)
+                key = (collection_name, doc_id)
+                if self._scheduled.get(key) != deadline:
+                    continue
+                del self._scheduled[key]
+                doc = storage.get(collection_name, {}).get(doc_id)
+                expires_at = doc.get(field) if doc else None
+                if not isinstance(expires_at, datetime):
+                    continue
+                if expires_at <= now:
+                    del storage[collection_name][doc_id]
+                else:
+                    # Re-issued with a later deadline since this entry was pushed
+                    self._scheduled[key] = expires_at
+                    heapq.heappush(self._heap, (expires_at, collection_name, doc_id, field))
+
+    def __len__(self):
+        return len(self._heap)
+
+class BulkSaveResult:
+    """Outcome of a bulk save; truthy when every record was written"""
+
+    def __init__(self):
+        self.matched = 0
+        self.upserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def add(self, matched, upserted):
+        self.matched += matched
+        self.upserted += upserted
+
+    def __bool__(self):
+        return self.failed == 0
+
+    def to_dict(self):
+        return {
+            'matched': self.matched,
+            'upserted': self.upserted,
+            'failed': self.failed,
+            'errors': self.errors[:10]
+        }
+
+def as_date(value):
+    """Normalize a stored premium_until (date, datetime or string) to a date, or None"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if hasattr(value, 'year'):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).date()
+    except ValueError:
+        return None
+
+def as_datetime(value):
+    """Accept a stored datetime or a legacy ISO string"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
 
 # Cleanup function
 def close_mongo_connection():
+    touch_buffer.flush()
     if Database._client:
         Database._client.close()
         logger.info("🔌 MongoDB connection closed")
         Database._client = None
         Database._db = None
+    if isinstance(Database._local, SQLiteBackend):
+        Database._local.close()
 
 atexit.register(close_mongo_connection)
 
@@ -346,33 +1936,24 @@ atexit.register(close_mongo_connection)
 # =============================================
 
 class EmailService:
+    @staticmethod
+    def is_configured():
+        return email_transport.is_configured()
+
     @staticmethod
     def send_otp_email(recipient_email, otp_code):
-        """Send OTP code to user's email"""
+        """Queue the OTP email; returns its outbox id, or False if it can't be sent"""
         try:
             # Check if email config is valid
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            
-            # Debug logging
-            logger.info(f"📧 Email Config Check:")
-            logger.info(f"   Sender Email: {'SET' if sender_email else 'MISSING'}")
-            logger.info(f"   Sender Password: {'SET' if sender_password else 'MISSING'}")
-            
-            if not sender_email or not sender_password:
-                logger.error("❌ Email configuration missing")
-                logger.error(f"   Email: {sender_email}")
-                logger.error(f"   Password: {'Set' if sender_password else 'Missing'}")
+            if not EmailService.is_configured():
+                logger.error(f"❌ Email configuration missing for {email_transport.name} transport")
+                logger.error(f"   Sender Email: {'SET' if EMAIL_CONFIG['sender_email'] else 'MISSING'}")
+                logger.error(f"   Sender Password: {'SET' if EMAIL_CONFIG['sender_password'] else 'MISSING'}")
                 return False
             
             logger.info(f"📧 Sending OTP to {recipient_email}")
             
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = sender_email
-            msg['To'] = recipient_email
-            msg['Subject'] = "CyberGuard NG - Email Verification OTP"
-            
+            subject = "CyberGuard NG - Email Verification OTP"
             body = f"""
             <html>
             <body style="font-family: Arial, sans-serif; line-height: 1.6;">
@@ -389,40 +1970,23 @@ class EmailService:
             </html>
             """
             
-            msg.attach(MIMEText(body, 'html'))
-            
-            # Connect to SMTP server
-            server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-            server.quit()
-            
-            logger.info(f"✅ OTP email sent to {recipient_email}")
-            return True
+            return email_outbox.enqueue('otp', recipient_email, subject, body)
         except Exception as e:
             logger.error(f"❌ Email error: {str(e)}")
             return False
 
     @staticmethod
     def send_password_reset_email(recipient_email, reset_token):
-        """Send password reset email"""
+        """Queue the password reset email; returns its outbox id, or False if it can't be sent"""
         try:
             # Check if email config is valid
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            
-            if not sender_email or not sender_password:
+            if not EmailService.is_configured():
                 logger.error("❌ Email configuration missing")
                 return False
             
             reset_link = f"https://cyber-guard-web.vercel.app/#reset-password?token={reset_token}"
             
-            msg = MIMEMultipart()
-            msg['From'] = sender_email
-            msg['To'] = recipient_email
-            msg['Subject'] = "CyberGuard NG - Password Reset Request"
-            
+            subject = "CyberGuard NG - Password Reset Request"
             body = f"""
             <html>
             <body style="font-family: Arial, sans-serif; line-height: 1.6;">
@@ -441,20 +2005,488 @@ class EmailService:
             </html>
             """
             
-            msg.attach(MIMEText(body, 'html'))
-            
-            server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-            server.quit()
-            
-            logger.info(f"✅ Password reset email sent to {recipient_email}")
-            return True
+            return email_outbox.enqueue('password_reset', recipient_email, subject, body)
         except Exception as e:
             logger.error(f"❌ Password reset email error: {e}")
             return False
 
+    @staticmethod
+    def deliver(recipient_email, subject, html):
+        """Hand one message to the configured transport right now; raises on failure"""
+        msg = MIMEMultipart()
+        msg['From'] = EMAIL_CONFIG['sender_email'] or 'noreply@cyberguard.local'
+        msg['To'] = recipient_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(html, 'html'))
+        
+        email_transport.send(msg)
+
+# =============================================
+# EMAIL TRANSPORTS
+# =============================================
+
+class EmailTransport:
+    """Where EmailService.deliver hands finished messages"""
+
+    name = None
+
+    def send(self, msg):
+        raise NotImplementedError
+
+    def is_configured(self):
+        return True
+
+    def close(self):
+        pass
+
+class SMTPTransport(EmailTransport):
+    """Real delivery over the pooled SMTP connections (Gmail, or any stand-in via SMTP_SERVER)"""
+
+    name = 'smtp'
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def send(self, msg):
+        self.pool.send(msg)
+
+    def is_configured(self):
+        # A local stand-in without STARTTLS usually needs no login either
+        if not EMAIL_CONFIG['sender_email']:
+            return False
+        return bool(EMAIL_CONFIG['sender_password']) or not EMAIL_CONFIG['smtp_starttls']
+
+    def close(self):
+        self.pool.close()
+
+class MemoryTransport(EmailTransport):
+    """Captures messages in memory for tests and load runs"""
+
+    name = 'memory'
+
+    def __init__(self, limit=1000):
+        self.messages = deque(maxlen=limit)
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        with self._lock:
+            self.messages.append(msg)
+            self.sent += 1
+
+    def find(self, recipient_email):
+        """Messages captured for one recipient, oldest first"""
+        with self._lock:
+            return [msg for msg in self.messages if msg['To'] == recipient_email]
+
+    def clear(self):
+        with self._lock:
+            self.messages.clear()
+
+class FileTransport(EmailTransport):
+    """Writes each message to <directory>/<timestamp>-<id>.eml"""
+
+    name = 'file'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, msg):
+        filename = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{secrets.token_hex(4)}.eml"
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            f.write(msg.as_bytes())
+
+# =============================================
+# SMTP CONNECTION POOL
+# =============================================
+
+class SMTPPool:
+    """Small pool of logged-in SMTP connections reused across sends.
+
+    A connection idle for longer than noop_after is probed with NOOP before use;
+    one idle past idle_timeout, or that has sent max_messages, is replaced.
+    """
+
+    def __init__(self, size=2, idle_timeout=60, max_messages=100, noop_after=10):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.noop_after = noop_after
+        self._idle = []  # [{'server', 'created_at', 'last_used', 'messages'}]
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.counts = {'opened': 0, 'reused': 0, 'recycled': 0, 'failed_checks': 0}
+
+    def _open(self):
+        server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'], timeout=30)
+        if EMAIL_CONFIG['smtp_starttls']:
+            server.starttls()
+        if EMAIL_CONFIG['sender_password']:
+            server.login(EMAIL_CONFIG['sender_email'], EMAIL_CONFIG['sender_password'])
+        self._count('opened')
+        now = time.monotonic()
+        return {'server': server, 'created_at': now, 'last_used': now, 'messages': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn['server'].quit()
+        except Exception:
+            try:
+                conn['server'].close()
+            except Exception:
+                pass
+
+    def _healthy(self, conn):
+        idle = time.monotonic() - conn['last_used']
+        if idle > self.idle_timeout or conn['messages'] >= self.max_messages:
+            self._count('recycled')
+            return False
+        if idle > self.noop_after:
+            try:
+                return conn['server'].noop()[0] == 250
+            except Exception:
+                self._count('failed_checks')
+                return False
+        return True
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._open(), False
+            if self._healthy(conn):
+                return conn, True
+            self._close(conn)
+
+    def send(self, msg):
+        """Send on a pooled connection; a reused one that turns out dead gets one retry on a fresh one"""
+        with self._slots:
+            conn, reused = self._acquire()
+            try:
+                conn['server'].send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self._close(conn)
+                if not reused:
+                    raise
+                conn = self._open()
+                try:
+                    conn['server'].send_message(msg)
+                except Exception:
+                    self._close(conn)
+                    raise
+            except Exception:
+                self._close(conn)
+                raise
+            if reused:
+                self._count('reused')
+            conn['messages'] += 1
+            conn['last_used'] = time.monotonic()
+            with self._lock:
+                self._idle.append(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, idle=len(self._idle), size=self.size)
+
+smtp_pool = SMTPPool(
+    size=int(os.environ.get('SMTP_POOL_SIZE', 2)),
+    idle_timeout=float(os.environ.get('SMTP_IDLE_SECONDS', 60)),
+    max_messages=int(os.environ.get('SMTP_MAX_MESSAGES', 100))
+)
+
+if EMAIL_CONFIG['transport'] == 'memory':
+    email_transport = MemoryTransport()
+elif EMAIL_CONFIG['transport'] == 'file':
+    email_transport = FileTransport(EMAIL_CONFIG['file_dir'])
+else:
+    email_transport = SMTPTransport(smtp_pool)
+atexit.register(email_transport.close)
+
+# =============================================
+# EMAIL OUTBOX
+# =============================================
+
+class EmailOutbox:
+    """Persistent email queue in email_outbox, delivered by a thread pool.
+
+    The request that enqueues a message claims it and hands it straight to the
+    pool. Failed sends are retried with exponential backoff by a sweeper thread,
+    which also rescues messages stuck in 'sending' (e.g. the instance died).
+    Messages that exhaust their attempts, or that the server refuses outright,
+    are dead-lettered.
+
+    Each claim carries a random claim_token, and next_attempt_at doubles as the
+    claim's lease deadline while a message is 'sending'. A worker renews the
+    lease right before sending and records the outcome only while it still
+    holds the token, so a message re-claimed by the sweeper isn't sent twice.
+    """
+
+    SENDING = 'sending'
+    RETRYING = 'retrying'
+    SENT = 'sent'
+    DEAD = 'dead'
+
+    # The body carries a plaintext OTP or reset link, so no row outlives this.
+    # Finished rows keep only delivery metadata for /api/email-status.
+    RETENTION = timedelta(days=1)
+
+    def __init__(self, workers=2, max_attempts=5, base_delay=30, max_delay=1800,
+                 sweep_interval=15, send_timeout=300, asynchronous=True, inline_sweep_limit=5):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sweep_interval = sweep_interval
+        self.send_timeout = send_timeout
+        self.asynchronous = asynchronous
+        self.inline_sweep_limit = inline_sweep_limit
+        self._pool = None
+        self._sweeper = None
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.counts = {'queued': 0, 'sent': 0, 'retried': 0, 'dead': 0}
+
+    def enqueue(self, kind, recipient_email, subject, html):
+        """Persist a message and start delivering it; returns its id, or False"""
+        now = datetime.utcnow()
+        message_id = secrets.token_hex(12)
+        doc = {
+            'message_id': message_id,
+            'kind': kind,
+            'recipient': recipient_email,
+            'subject': subject,
+            'html': html,
+            'status': EmailOutbox.SENDING,
+            'attempts': 0,
+            'created_at': now,
+            'claimed_at': now,
+            'claim_token': secrets.token_hex(8),
+            'next_attempt_at': now + timedelta(seconds=self.send_timeout),
+            'last_error': None,
+            'expires_at': now + EmailOutbox.RETENTION
+        }
+        if not Database.insert_outbox_message(doc):
+            return False
+        self._count('queued')
+
+        if not self.asynchronous:
+            # Serverless hosts freeze threads once the response is sent, so
+            # deliver inline and piggyback due retries on this request instead
+            delivered = self._deliver(doc)
+            if time.monotonic() - self._swept_at >= self.sweep_interval:
+                self._swept_at = time.monotonic()
+                try:
+                    self.sweep(limit=self.inline_sweep_limit)
+                except Exception as e:
+                    logger.error(f"Email outbox sweep failed: {e}")
+            return message_id if delivered else False
+        self._start()
+        self._pool.submit(self._deliver, doc)
+        return message_id
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='email')
+                self._sweeper = threading.Thread(target=self._run_sweeper, daemon=True)
+                self._sweeper.start()
+
+    def _owned(self, doc, fields):
+        """Write `fields` only if this worker still holds the message's claim"""
+        return Database.find_one_and_update(
+            'email_outbox', doc['message_id'],
+            {'status': EmailOutbox.SENDING, 'claim_token': doc.get('claim_token')},
+            fields
+        ) is not None
+
+    def _deliver(self, doc):
+        message_id = doc['message_id']
+        attempts = doc['attempts'] + 1
+        now = datetime.utcnow()
+        # The claim may have sat in the pool past its lease and been re-claimed
+        if not self._owned(doc, {'claimed_at': now, 'next_attempt_at': now + timedelta(seconds=self.send_timeout)}):
+            logger.info(f"↪️ {doc['kind']} email {message_id} was re-claimed elsewhere - skipping")
+            return False
+        try:
+            EmailService.deliver(doc['recipient'], doc['subject'], doc['html'])
+        except Exception as e:
+            self._failed(doc, attempts, e)
+            return False
+
+        now = datetime.utcnow()
+        # Drop the body once sent: it carries the OTP or reset link
+        if not self._owned(doc, {
+            'status': EmailOutbox.SENT,
+            'attempts': attempts,
+            'sent_at': now,
+            'html': None,
+            'last_error': None,
+            'expires_at': now + EmailOutbox.RETENTION
+        }):
+            logger.warning(f"⚠️ {doc['kind']} email {message_id} sent after its claim lapsed")
+        self._count('sent')
+        logger.info(f"✅ {doc['kind']} email sent to {doc['recipient']}")
+        return True
+
+    def _failed(self, doc, attempts, error):
+        now = datetime.utcnow()
+        permanent = isinstance(error, smtplib.SMTPRecipientsRefused)
+        if permanent or attempts >= self.max_attempts:
+            self._owned(doc, {
+                'status': EmailOutbox.DEAD,
+                'attempts': attempts,
+                'html': None,
+                'last_error': str(error),
+                'expires_at': now + EmailOutbox.RETENTION
+            })
+            self._count('dead')
+            logger.error(f"☠️ Dead-lettered {doc['kind']} email {doc['message_id']} after {attempts} attempts: {error}")
+            return
+
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        self._owned(doc, {
+            'status': EmailOutbox.RETRYING,
+            'attempts': attempts,
+            'last_error': str(error),
+            'next_attempt_at': now + timedelta(seconds=delay)
+        })
+        self._count('retried')
+        logger.warning(f"⚠️ {doc['kind']} email {doc['message_id']} failed ({error}) - retry in {delay}s")
+
+    def _run_sweeper(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Email outbox sweep failed: {e}")
+
+    def sweep(self, limit=100):
+        """Claim due retries and stuck sends; a conditional update makes each claim exclusive"""
+        now = datetime.utcnow()
+        # For 'sending' rows next_attempt_at is the lease deadline, so both are "due"
+        due = Database.find_by('email_outbox', 'status', EmailOutbox.RETRYING, limit, before=('next_attempt_at', now))
+        stuck = Database.find_by('email_outbox', 'status', EmailOutbox.SENDING, limit, before=('next_attempt_at', now))
+        for doc in due + stuck:
+            claim = {
+                'status': EmailOutbox.SENDING,
+                'claimed_at': now,
+                'claim_token': secrets.token_hex(8),
+                'next_attempt_at': now + timedelta(seconds=self.send_timeout)
+            }
+            claimed = Database.find_one_and_update(
+                'email_outbox', doc['message_id'],
+                {'status': doc['status'], 'claim_token': doc.get('claim_token')},
+                claim
+            )
+            if claimed:
+                self._dispatch(dict(claimed, **claim))
+        return len(due) + len(stuck)
+
+    def _dispatch(self, doc):
+        if not self.asynchronous:
+            self._deliver(doc)
+            return
+        self._start()
+        self._pool.submit(self._deliver, doc)
+
+    def status(self, message_id):
+        doc = Database.get_outbox_message(message_id)
+        if not doc:
+            return None
+        def iso(value):
+            return value.isoformat() if isinstance(value, datetime) else value
+        return {
+            'email_id': message_id,
+            'kind': doc['kind'],
+            'status': doc['status'],
+            'attempts': doc['attempts'],
+            'last_error': doc.get('last_error'),
+            'created_at': iso(doc.get('created_at')),
+            'sent_at': iso(doc.get('sent_at')),
+            'next_attempt_at': iso(doc.get('next_attempt_at')) if doc['status'] == EmailOutbox.RETRYING else None
+        }
+
+    def stats(self):
+        return dict(self.counts, workers=self.workers, asynchronous=self.asynchronous)
+
+email_outbox = EmailOutbox(
+    workers=int(os.environ.get('EMAIL_WORKERS', 2)),
+    max_attempts=int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5)),
+    base_delay=float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 30)),
+    sweep_interval=float(os.environ.get('EMAIL_SWEEP_SECONDS', 15)),
+    # Background threads don't survive between invocations on Vercel, so default to inline there
+    asynchronous=os.environ.get('EMAIL_ASYNC', 'false' if os.environ.get('VERCEL') == '1' else 'true').lower() == 'true'
+)
+
+# =============================================
+# SIGNED SESSION REVOCATION
+# =============================================
+
+class RevocationSet:
+    """In-memory set of revoked signed-session ids, re-read from revoked_sessions every sync interval"""
+
+    def __init__(self, sync_interval=30):
+        self.sync_interval = sync_interval
+        self._revoked = {}  # session id -> expires_at (UTC datetime)
+        self._synced_at = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def revoke(self, session_id, user_id, expires_at):
+        with self._lock:
+            self._revoked[session_id] = expires_at
+        return Database.replace_one('revoked_sessions', session_id, {
+            'session_id': session_id,
+            'user_id': user_id,
+            'revoked_at': datetime.utcnow(),
+            'expires_at': expires_at
+        })
+
+    def is_revoked(self, session_id):
+        if time.time() - self._synced_at >= self.sync_interval:
+            # One request reloads; the rest answer from the current set meanwhile
+            if self._sync_lock.acquire(blocking=False):
+                try:
+                    if time.time() - self._synced_at >= self.sync_interval:
+                        self._sync()
+                finally:
+                    self._sync_lock.release()
+        return session_id in self._revoked
+
+    def sync(self):
+        """Pick up logouts made on other instances and forget expired entries"""
+        with self._sync_lock:
+            self._sync()
+
+    def _sync(self):
+        self._synced_at = time.time()
+        docs = Database.load_revoked_sessions()
+        now = datetime.utcnow()
+        with self._lock:
+            for session_id, doc in docs.items():
+                self._revoked[session_id] = as_datetime(doc['expires_at'])
+            self._revoked = {sid: exp for sid, exp in self._revoked.items() if exp > now}
+
+revoked_sessions = RevocationSet(sync_interval=float(os.environ.get('REVOCATION_SYNC_SECONDS', 30)))
+
 # =============================================
 # ENHANCED AUTHENTICATION MANAGER
 # =============================================
@@ -479,10 +2511,75 @@ class AuthManager:
     @staticmethod
     def generate_reset_token():
         return secrets.token_urlsafe(32)
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
     
+    @staticmethod
+    def signed_sessions():
+        if SESSION_MODE != 'signed':
+            return False
+        if not SESSION_SECRET:
+            logger.warning("⚠️ SESSION_MODE=signed without SESSION_SECRET - using database sessions")
+            return False
+        return True
+
+    @staticmethod
+    def _b64(data):
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    @staticmethod
+    def _unb64(text):
+        return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+    @staticmethod
+    def _sign(payload):
+        return hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+
+    @staticmethod
+    def _ip_hash(ip_address):
+        return hashlib.sha256(f"{SESSION_SECRET}:{ip_address}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def create_signed_session(user_id):
+        """'v1.<payload>.<signature>' carrying session id, user id, issue time, expiry and IP hash"""
+        issued_at = int(time.time())
+        claims = {
+            'sid': secrets.token_hex(8),
+            'uid': user_id,
+            'iat': issued_at,
+            'exp': issued_at + SESSION_DAYS * 86400,
+            'ip': AuthManager._ip_hash(request.remote_addr)
+        }
+        payload = AuthManager._b64(json.dumps(claims, separators=(',', ':')).encode())
+        return f"v1.{payload}.{AuthManager._b64(AuthManager._sign(payload))}"
+
+    @staticmethod
+    def parse_signed_session(session_token):
+        """Return the claims of a correctly signed, unexpired token, else None"""
+        if not SESSION_SECRET:
+            return None
+        try:
+            version, payload, signature = session_token.split('.')
+            if version != 'v1' or not hmac.compare_digest(AuthManager._unb64(signature), AuthManager._sign(payload)):
+                return None
+            claims = json.loads(AuthManager._unb64(payload))
+        except (ValueError, TypeError):
+            return None
+        if claims.get('exp', 0) <= time.time():
+            return None
+        return claims
+
+    @staticmethod
+    def _revoke_signed_session(claims):
+        return revoked_sessions.revoke(claims['sid'], claims['uid'], datetime.utcfromtimestamp(claims['exp']))
+
     @staticmethod
     def create_session(user_id):
-        sessions = Database.load_sessions()
+        if AuthManager.signed_sessions():
+            return AuthManager.create_signed_session(user_id)
+
         session_token = AuthManager.generate_session_token()
         
         session_data = {
@@ -491,46 +2588,214 @@ class AuthManager:
             'ip_address': request.remote_addr,
             'user_agent': request.headers.get('User-Agent', ''),
             'created_at': datetime.now().isoformat(),
-            'expires_at': (datetime.now() + timedelta(days=30)).isoformat(),
+            # Stored as a UTC datetime so the TTL index can expire it
+            'expires_at': datetime.utcnow() + timedelta(days=SESSION_DAYS),
             'last_accessed': datetime.now().isoformat()
         }
         
-        sessions[session_token] = session_data
-        Database.save_sessions(sessions)
+        Database.insert_session(session_data)
         return session_token
     
     @staticmethod
     def validate_session(session_token):
-        sessions = Database.load_sessions()
-        if session_token in sessions:
-            session_data = sessions[session_token]
-            expires_at = datetime.fromisoformat(session_data['expires_at'])
-            
-            if datetime.now() > expires_at:
-                del sessions[session_token]
-                Database.save_sessions(sessions)
+        if not session_token:
+            return None
+
+        if session_token.startswith('v1.'):
+            # Signed token: no database read unless the revocation set is due a sync
+            claims = AuthManager.parse_signed_session(session_token)
+            if not claims or revoked_sessions.is_revoked(claims['sid']):
+                return None
+            if not hmac.compare_digest(claims['ip'], AuthManager._ip_hash(request.remote_addr)):
+                AuthManager._revoke_signed_session(claims)
+                return None
+            return claims['uid']
+
+        session_data = Database.get_session(session_token)
+        if session_data:
+            # The TTL monitor only sweeps once a minute, so check the deadline too
+            if datetime.utcnow() > as_datetime(session_data['expires_at']):
                 return None
             
             if session_data.get('ip_address') != request.remote_addr:
-                del sessions[session_token]
-                Database.save_sessions(sessions)
+                Database.delete_session(session_token)
                 return None
             
-            session_data['last_accessed'] = datetime.now().isoformat()
-            sessions[session_token] = session_data
-            Database.save_sessions(sessions)
+            touch_buffer.touch('sessions', session_token, 'last_accessed', datetime.now().isoformat())
             
             return session_data['user_id']
         return None
 
     @staticmethod
     def logout_session(session_token):
-        sessions = Database.load_sessions()
-        if session_token in sessions:
-            del sessions[session_token]
-            Database.save_sessions(sessions)
-            return True
-        return False
+        if not session_token:
+            return False
+        if session_token.startswith('v1.'):
+            claims = AuthManager.parse_signed_session(session_token)
+            return bool(claims) and AuthManager._revoke_signed_session(claims)
+        return Database.delete_session(session_token)
+
+# =============================================
+# USER RECORD WITH DIRTY TRACKING
+# =============================================
+
+class UserRecord(dict):
+    """User document that remembers which fields changed since it was loaded"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dirty = set()
+        self._inc = {}
+        self._unset = set()
+
+    @staticmethod
+    def wrap(doc):
+        if doc is None or isinstance(doc, UserRecord):
+            return doc
+        return UserRecord(doc)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._inc.pop(key, None)
+        self._unset.discard(key)
+        self._dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._dirty.discard(key)
+        self._inc.pop(key, None)
+        self._unset.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return super().pop(key, *default)
+
+    def increment(self, key, amount=1):
+        """Bump a counter locally and record it as a $inc"""
+        super().__setitem__(key, self.get(key, 0) + amount)
+        if key in self._dirty:
+            # Already being $set (e.g. a reset), so the new value rides along
+            return
+        self._inc[key] = self._inc.get(key, 0) + amount
+
+    def refresh(self, fields):
+        """Apply values already persisted elsewhere without marking them dirty"""
+        for key, value in fields.items():
+            super().__setitem__(key, value)
+            self._dirty.discard(key)
+            self._inc.pop(key, None)
+
+    def mark_dirty(self, key):
+        """Flag a field whose nested value was mutated in place"""
+        if key in self:
+            self._dirty.add(key)
+
+    def is_dirty(self):
+        return bool(self._dirty or self._inc or self._unset)
+
+    def pending_changes(self):
+        sets = {key: self[key] for key in self._dirty if key in self}
+        return sets, dict(self._inc), set(self._unset)
+
+    def mark_clean(self):
+        self._dirty.clear()
+        self._inc.clear()
+        self._unset.clear()
+
+# =============================================
+# REQUEST-SCOPED UNIT OF WORK
+# =============================================
+
+class UnitOfWork:
+    """Per-request identity map: each user/payment is fetched once and written once"""
+
+    def __init__(self):
+        self.users = {}
+        self.payments = {}
+        self.payment_updates = {}
+        self.db_ops = 0
+
+    @staticmethod
+    def current():
+        if not has_request_context():
+            return None
+        if 'unit_of_work' not in g:
+            g.unit_of_work = UnitOfWork()
+        return g.unit_of_work
+
+    def register_user(self, user):
+        """Track a loaded user, returning the instance already tracked for that id"""
+        if user is None:
+            return None
+        return self.users.setdefault(user['id'], user)
+
+    def owns_user(self, user):
+        return self.users.get(user.get('id')) is user
+
+    def register_payment(self, payment):
+        if payment is None:
+            return None
+        return self.payments.setdefault(payment['id'], payment)
+
+    def update_payment(self, payment_id, updates):
+        if payment_id in self.payments:
+            self.payments[payment_id].update(updates)
+        self.payment_updates.setdefault(payment_id, {}).update(updates)
+
+    def flush(self):
+        """Write every pending change as one update per document; False if any write failed"""
+        ok = True
+        for user in self.users.values():
+            if user.is_dirty() and not Database.save_user_record(user):
+                logger.error(f"❌ Failed to save user {user['id']}")
+                ok = False
+        pending, self.payment_updates = self.payment_updates, {}
+        for payment_id, updates in pending.items():
+            if not Database.update_payment_fields(payment_id, updates):
+                logger.error(f"❌ Failed to update payment {payment_id}")
+                ok = False
+        return ok
+
+DB_OPS_HEADER = os.environ.get('DB_OPS_HEADER', 'false').lower() == 'true'
+
+@app.after_request
+def flush_unit_of_work(response):
+    uow = g.get('unit_of_work')
+    if uow is not None:
+        try:
+            saved = uow.flush()
+        except Exception as e:
+            logger.error(f"Unit of work flush failed: {e}")
+            saved = False
+        if not saved and response.status_code < 400:
+            # The handler already answered as if its writes had landed
+            response = jsonify({'success': False, 'message': 'Failed to save changes'})
+            response.status_code = 500
+        if DB_OPS_HEADER or app.debug:
+            response.headers['X-DB-Operations'] = str(uow.db_ops)
+    return response
+
+@app.teardown_request
+def teardown_unit_of_work(exc):
+    # after_request is skipped on unhandled errors; don't lose the writes
+    uow = g.get('unit_of_work')
+    if uow is not None:
+        try:
+            uow.flush()
+        except Exception as e:
+            logger.error(f"Unit of work flush failed: {e}")
 
 # =============================================
 # ENHANCED USER MANAGER
@@ -539,14 +2804,8 @@ class AuthManager:
 class UserManager:
     @staticmethod
     def create_user(email, password, phone_number, name=None):
-        users = Database.load_users()
         user_id = 'user_' + str(int(datetime.now().timestamp()))
         
-        # Check if email already exists
-        for existing_user in users.values():
-            if existing_user.get('email') == email:
-                return None, "Email already registered"
-        
         user_data = {
             'id': user_id,
             'email': email,
@@ -562,88 +2821,105 @@ class UserManager:
             'total_checks': 0,
             'payment_pending': False,
             'created_at': datetime.now().isoformat(),
-            'last_login': datetime.now().isoformat(),
-            'reset_tokens': []  # Store reset tokens for security
+            'last_login': datetime.now().isoformat()
         }
         
-        users[user_id] = user_data
-        if Database.save_users(users):
-            return user_data, None
+        # The unique index on email rejects duplicates; an _id clash only means
+        # two signups landed in the same second, so retry with a suffixed id
+        for attempt in range(3):
+            try:
+                Database.insert_user(user_data)
+                return user_data, None
+            except DuplicateKeyError as e:
+                if 'email' in (e.details or {}).get('keyPattern', {}):
+                    return None, "Email already registered"
+                user_data['id'] = f"{user_id}_{secrets.token_hex(2)}"
+            except Exception as e:
+                logger.error(f"Error creating user {user_data['id']}: {e}")
+                break
         return None, "Failed to save user"
 
     @staticmethod
     def authenticate_user(email, password):
-        users = Database.load_users()
-        for user in users.values():
-            if user.get('email') == email and AuthManager.verify_password(password, user['password_hash']):
-                user['last_login'] = datetime.now().isoformat()
-                users[user['id']] = user
-                Database.save_users(users)
-                return user
+        user = UserManager.get_user_by_email(email, fresh=True)
+        if user and AuthManager.verify_password(password, user['password_hash']):
+            user['last_login'] = datetime.now().isoformat()
+            UserManager.save_user(user)
+            return user
         return None
 
     @staticmethod
     def get_user(user_id):
-        users = Database.load_users()
-        if user_id in users:
-            users[user_id]['last_active'] = datetime.now().isoformat()
-            Database.save_users(users)
-            return users[user_id]
+        uow = UnitOfWork.current()
+        if uow is not None and user_id in uow.users:
+            return uow.users[user_id]
+
+        user = Database.get_user(user_id)
+        if user:
+            now = datetime.now().isoformat()
+            user.refresh({'last_active': now})
+            touch_buffer.touch('users', user_id, 'last_active', now)
+            if uow is not None:
+                return uow.register_user(user)
+            return user
         return None
 
     @staticmethod
-    def get_user_by_email(email):
-        users = Database.load_users()
-        for user in users.values():
+    def get_user_by_email(email, fresh=False):
+        uow = UnitOfWork.current()
+        if uow is None:
+            return Database.get_user_by_email(email, fresh)
+        if fresh:
+            user = Database.get_user_by_email(email, fresh=True)
+            tracked = uow.users.get(user['id']) if user else None
+            if tracked is None:
+                return uow.register_user(user)
+            if not tracked.is_dirty():
+                tracked.refresh(user)
+            # Otherwise this request's own pending writes are the newest values
+            return tracked
+        for user in uow.users.values():
             if user.get('email') == email:
                 return user
-        return None
+        return uow.register_user(Database.get_user_by_email(email))
 
     @staticmethod
     def verify_user_email(user_id):
-        users = Database.load_users()
-        if user_id in users:
-            users[user_id]['is_verified'] = True
-            return Database.save_users(users)
-        return False
+        uow = UnitOfWork.current()
+        if uow is not None and user_id in uow.users:
+            user = uow.users[user_id]
+            user['is_verified'] = True
+            return UserManager.save_user(user, sync=True)
+        return Database.update_user_fields(user_id, {'is_verified': True})
 
     @staticmethod
-    def save_user(user):
-        users = Database.load_users()
-        users[user['id']] = user
-        return Database.save_users(users)
+    def save_user(user, sync=False):
+        """Defer the write to the end of the request unless the caller needs the result now"""
+        uow = UnitOfWork.current()
+        if not sync and uow is not None and uow.owns_user(user):
+            # Written once when the request finishes
+            return True
+        if isinstance(user, UserRecord):
+            saved = Database.save_user_record(user)
+            if not saved and sync:
+                # The caller reports the failure; the end-of-request flush mustn't retry it
+                user.mark_clean()
+            return saved
+        return Database.update_user_fields(user['id'], user)
 
     @staticmethod
     def get_all_users():
         return Database.load_users()
 
     @staticmethod
-    def can_make_free_check(user):
+    def consume_check(user, amount=1):
+        """Enforce the free limit and record `amount` checks in one atomic update"""
         if not user:
             return False
-            
-        today = str(datetime.now().date())
-        if user.get('last_check_date') != today:
-            user['checks_today'] = 0
-            user['last_check_date'] = today
-        
-        if user['is_premium'] and user.get('premium_until'):
-            premium_until = datetime.strptime(user['premium_until'], '%Y-%m-%d').date() if isinstance(user['premium_until'], str) else user['premium_until']
-            if datetime.now().date() > premium_until:
-                user['is_premium'] = False
-                user['premium_until'] = None
-                user['premium_plan'] = None
-            else:
-                return True
-        
-        return user['checks_today'] < 5
-
-    @staticmethod
-    def record_check(user):
-        user['checks_today'] += 1
-        user['total_checks'] += 1
-        user['last_check_date'] = str(datetime.now().date())
-        UserManager.save_user(user)
+        allowed, fields = Database.consume_checks(user['id'], FREE_DAILY_CHECKS, amount)
+        if fields:
+            user.refresh(fields)
+        return allowed
 
     @staticmethod
     def activate_premium(user, plan_type):
@@ -652,7 +2928,8 @@ class UserManager:
         plan_duration = PRICING_PLANS[plan_type]['duration']
         user['premium_until'] = str((datetime.now() + timedelta(days=plan_duration)).date())
         user['payment_pending'] = False
-        UserManager.save_user(user)
+        if not UserManager.save_user(user, sync=True):
+            return None
         return user
 
     @staticmethod
@@ -661,55 +2938,50 @@ class UserManager:
         if not user:
             return None
         
+        # Only the hash is stored; expired tokens are removed by the TTL index
         reset_token = AuthManager.generate_reset_token()
         token_data = {
-            'token': reset_token,
-            'created_at': datetime.now().isoformat(),
-            'expires_at': (datetime.now() + timedelta(hours=1)).isoformat(),
+            'token_hash': AuthManager.hash_token(reset_token),
+            'user_id': user['id'],
+            'email': user['email'],
+            'created_at': datetime.utcnow(),
+            'expires_at': datetime.utcnow() + timedelta(hours=1),
             'used': False
         }
-        
-        if 'reset_tokens' not in user:
-            user['reset_tokens'] = []
-        
-        # Remove expired tokens
-        user['reset_tokens'] = [
-            token for token in user.get('reset_tokens', [])
-            if datetime.now() < datetime.fromisoformat(token['expires_at']) and not token['used']
-        ]
-        
-        user['reset_tokens'].append(token_data)
-        UserManager.save_user(user)
+        if not Database.insert_reset_token(token_data):
+            return None
         
         return reset_token
 
     @staticmethod
-    def validate_reset_token(email, token):
-        user = UserManager.get_user_by_email(email)
-        if not user or 'reset_tokens' not in user:
+    def _reset_token_usable(token_data, email=None):
+        if not token_data or (email and token_data['email'] != email):
             return False
-        
-        for token_data in user['reset_tokens']:
-            if (token_data['token'] == token and 
-                not token_data['used'] and 
-                datetime.now() < datetime.fromisoformat(token_data['expires_at'])):
-                return True
-        
-        return False
+        if datetime.utcnow() > as_datetime(token_data['expires_at']):
+            return False
+        # Tokens issued before the last password change are void
+        user = UserManager.get_user_by_email(token_data['email'], fresh=True)
+        if not user:
+            return False
+        changed_at = user.get('password_changed_at')
+        return not changed_at or as_datetime(token_data['created_at']) > as_datetime(changed_at)
+
+    @staticmethod
+    def validate_reset_token(email, token):
+        token_data = Database.get_reset_token(AuthManager.hash_token(token))
+        return bool(token_data) and not token_data['used'] and UserManager._reset_token_usable(token_data, email)
+
+    @staticmethod
+    def redeem_reset_token(token):
+        """Mark a reset token used in one atomic step; returns the owner's email if it was valid"""
+        token_data = Database.claim_reset_token(AuthManager.hash_token(token))
+        if not UserManager._reset_token_usable(token_data):
+            return None
+        return token_data['email']
 
     @staticmethod
     def use_reset_token(email, token):
-        user = UserManager.get_user_by_email(email)
-        if not user:
-            return False
-        
-        for token_data in user['reset_tokens']:
-            if token_data['token'] == token:
-                token_data['used'] = True
-                token_data['used_at'] = datetime.now().isoformat()
-                return UserManager.save_user(user)
-        
-        return False
+        return UserManager.redeem_reset_token(token) == email
 
     @staticmethod
     def update_password(email, new_password):
@@ -718,9 +2990,12 @@ class UserManager:
             return False
         
         user['password_hash'] = AuthManager.hash_password(new_password)
-        # Clear all reset tokens after password change
-        user['reset_tokens'] = []
-        return UserManager.save_user(user)
+        # Voids every reset token issued before now
+        user['password_changed_at'] = datetime.utcnow().isoformat()
+        # Drop the reset tokens older accounts still carry inline
+        user.pop('reset_tokens', None)
+        # The token is already spent; report a failed write instead of deferring it
+        return UserManager.save_user(user, sync=True)
 
 # =============================================
 # OTP MANAGER
@@ -729,41 +3004,32 @@ class UserManager:
 class OTPManager:
     @staticmethod
     def generate_and_send_otp(email):
-        otp_storage = Database.load_otp_storage()
         otp_code = AuthManager.generate_otp()
         
         otp_data = {
             'otp_code': otp_code,
             'email': email,
             'created_at': datetime.now().isoformat(),
-            'expires_at': (datetime.now() + timedelta(minutes=10)).isoformat(),
-            'verified': False
+            'expires_at': datetime.utcnow() + timedelta(minutes=10),
+            'verified': False,
+            'attempts': 0
         }
         
-        otp_storage[email] = otp_data
-        Database.save_otp_storage(otp_storage)
+        Database.set_otp(otp_data)
         
         return EmailService.send_otp_email(email, otp_code)
     
     @staticmethod
     def verify_otp(email, otp_code):
-        otp_storage = Database.load_otp_storage()
-        if email in otp_storage:
-            otp_data = otp_storage[email]
-            expires_at = datetime.fromisoformat(otp_data['expires_at'])
-            
-            if datetime.now() < expires_at and otp_data['otp_code'] == otp_code:
-                otp_data['verified'] = True
-                otp_storage[email] = otp_data
-                Database.save_otp_storage(otp_storage)
-                return True
-        return False
+        if not email or not otp_code:
+            return False
+        return Database.verify_otp(email, str(otp_code).strip(), OTP_MAX_ATTEMPTS)
     
     @staticmethod
     def is_verified(email):
-        otp_storage = Database.load_otp_storage()
-        if email in otp_storage:
-            return otp_storage[email].get('verified', False)
+        otp_data = Database.get_otp(email)
+        if otp_data:
+            return otp_data.get('verified', False)
         return False
 
 # =============================================
@@ -773,7 +3039,6 @@ class OTPManager:
 class PaymentManager:
     @staticmethod
     def create_payment(user_id, plan_type, phone_number, name=None):
-        payments = Database.load_payments()
         payment_id = f"pay_{datetime.now().strftime('%Y%m%d%H%M%S')}_{random.randint(1000,9999)}"
         
         payment = {
@@ -788,8 +3053,11 @@ class PaymentManager:
             'verified_at': None
         }
         
-        payments[payment_id] = payment
-        if Database.save_payments(payments):
+        if Database.insert_payment(payment):
+            uow = UnitOfWork.current()
+            if uow is not None:
+                uow.register_payment(payment)
+
             # Update user to show payment pending
             user = UserManager.get_user(user_id)
             if user:
@@ -803,96 +3071,804 @@ class PaymentManager:
     
     @staticmethod
     def get_payment(payment_id):
-        payments = Database.load_payments()
-        return payments.get(payment_id)
+        uow = UnitOfWork.current()
+        if uow is None:
+            return Database.get_payment(payment_id)
+        if payment_id not in uow.payments:
+            return uow.register_payment(Database.get_payment(payment_id))
+        return uow.payments[payment_id]
     
     @staticmethod
-    def update_payment(payment_id, updates):
-        payments = Database.load_payments()
-        if payment_id in payments:
-            payments[payment_id].update(updates)
-            return Database.save_payments(payments)
-        return False
+    def update_payment(payment_id, updates, sync=False):
+        uow = UnitOfWork.current()
+        if uow is not None:
+            uow.update_payment(payment_id, updates)
+            if not sync:
+                return True
+            # Write now, along with anything already pending for this payment
+            return Database.update_payment_fields(payment_id, uow.payment_updates.pop(payment_id))
+        return Database.update_payment_fields(payment_id, updates)
     
     @staticmethod
     def get_all_payments():
         return Database.load_payments()
 
 # =============================================
-# SIMPLE SCANNER CLASS
+# SIMPLE SCANNER CLASS
+# =============================================
+
+URL_SCAM_DOMAINS = frozenset([
+    'tcnnationalizeuze.site', 'gtbank-verify.tk',
+    'nigerianlottery.com', 'zenithbank-update.xyz',
+    'profitize.site', 'moneytized.online'
+])
+
+URL_LEGITIMATE_DOMAINS = frozenset([
+    'zenithbank.com', 'facebook.com', 'google.com',
+    'gtbank.com', 'firstbanknigeria.com', 'accessbankplc.com'
+])
+
+URL_SUSPICIOUS_TLDS = ('.tk', '.ml', '.ga', '.cf', '.xyz', '.top', '.club', '.site', '.online')
+
+def normalize_host(host):
+    """Lowercase ASCII form of a hostname with IDN labels in punycode ('' if empty or malformed)"""
+    host = host.strip().rstrip('.').lower()
+    if not host.isascii():
+        try:
+            # nameprep also folds full-width dots and compatibility characters
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            host = '.'.join(
+                label if label.isascii() else 'xn--' + label.encode('punycode').decode('ascii')
+                for label in host.split('.')
+            )
+    # 'a..tk' or '.tk' has an empty label; no resolver accepts that
+    if '' in host.split('.'):
+        return ''
+    return host
+
+def url_host(url):
+    """Host of a URL or bare domain, without scheme, userinfo, port or path ('' if none)"""
+    try:
+        # Browsers treat backslashes as slashes, so 'evil.tk\@bank.com' is evil.tk
+        url = url.strip().replace('\\', '/')
+        if not re.match(r'^[a-z][a-z0-9+.-]*://', url, re.IGNORECASE):
+            url = 'http://' + url
+        domain = normalize_host(urlsplit(url).hostname or '')
+        # Anything else (spaces, quotes, stray symbols) is not a host a browser would resolve
+        if not re.fullmatch(r'[a-z0-9_.:-]+', domain):
+            return ''
+        return domain
+    except ValueError:
+        return ''
+
+class DomainTrie:
+    """Trie over reversed domain labels: is a host, or any parent domain, listed? in O(labels)"""
+
+    _END = object()  # can never equal a label, so it safely marks a listed domain
+
+    def __init__(self, domains=()):
+        self._root = {}
+        self.size = 0
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        # '*.example.com' and '.tk' both list the suffix itself
+        domain = normalize_host(domain.lstrip('*.'))
+        if not domain:
+            return
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        if self._END not in node:
+            node[self._END] = True
+            self.size += 1
+
+    def match(self, host):
+        """Return the most specific listed suffix of a normalized host, or None"""
+        labels = host.split('.')
+        node = self._root
+        found = None
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                break
+            if self._END in node:
+                found = i
+        return '.'.join(labels[found:]) if found is not None else None
+
+    def __contains__(self, host):
+        return self.match(host) is not None
+
+    def __len__(self):
+        return self.size
+
+# =============================================
+# MAPPED DOMAIN BLOCKLIST
 # =============================================
 
+class MappedBlocklist:
+    """Sorted on-disk domain list opened read-only with mmap.
+
+    Layout (little-endian): header '<4sII' (magic, format version, count),
+    count + 1 uint32 offsets, then the normalized domains concatenated in
+    bytewise order. Lookups binary-search the mapped pages directly, so every
+    worker process shares one copy in the OS page cache and opening is O(1).
+    """
+
+    MAGIC = b'CGBL'
+    FORMAT_VERSION = 1
+    HEADER = struct.Struct('<4sII')
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError("Blocklist offsets are little-endian; unsupported on this platform")
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies the file actually mapped; build-blocklist swaps in a new inode
+        self.identity = (st.st_ino, st.st_mtime_ns)
+        magic, version, count = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC or version != self.FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is not a v{self.FORMAT_VERSION} blocklist")
+        self.count = count
+        self._data = self.HEADER.size + 4 * (count + 1)
+        self._offsets = memoryview(self._mm)[self.HEADER.size:self._data].cast('I')
+
+    def __contains__(self, domain):
+        try:
+            key = domain.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+        mm, offsets, data = self._mm, self._offsets, self._data
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            start = data + offsets[mid]
+            probe = mm[start:data + offsets[mid + 1]]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def match(self, host):
+        """Return the most specific listed suffix of a normalized host, or None"""
+        labels = host.split('.')
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:])
+            if suffix in self:
+                return suffix
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._offsets.release()
+        self._mm.close()
+
+def parse_blocklist_line(line):
+    """Domain from one plaintext list line: bare domains, hosts files, '||domain^' rules or URLs"""
+    line = line.split('#', 1)[0].strip()
+    if not line or line.startswith('!'):
+        return ''
+    entry = line.split()[-1].lower()
+    entry = entry.lstrip('|').rstrip('^').lstrip('*.')
+    # Most lines are already bare ASCII domains; skip URL parsing for those
+    if re.fullmatch(r'[a-z0-9_-]+(\.[a-z0-9_-]+)*\.?', entry):
+        return entry.rstrip('.')
+    return url_host(entry)
+
+def build_blocklist(sources, output):
+    """Compile plaintext domain lists into a MappedBlocklist file; returns the entry count"""
+    domains = set()
+    for source in sources:
+        with open(source, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                domain = parse_blocklist_line(line)
+                # hosts files map these to 0.0.0.0 too; they aren't blocklist entries
+                if domain and domain not in ('localhost', '0.0.0.0', '127.0.0.1', '::1'):
+                    domains.add(domain.encode('ascii'))
+
+    keys = sorted(domains)
+    offsets = [0]
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+    if offsets[-1] >= 2 ** 32:
+        raise ValueError("Blocklist data exceeds the 4 GB offset range")
+
+    # Write beside the target and rename, so workers never map a half-written file
+    tmp_path = f"{output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MappedBlocklist.HEADER.pack(MappedBlocklist.MAGIC, MappedBlocklist.FORMAT_VERSION, len(keys)))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        for key in keys:
+            f.write(key)
+    os.replace(tmp_path, output)
+    return len(keys)
+
 class SimpleScanner:
-    def __init__(self):
-        self.known_scam_domains = {
-            'tcnnationalizeuze.site', 'gtbank-verify.tk', 
-            'nigerianlottery.com', 'zenithbank-update.xyz',
-            'profitize.site', 'moneytized.online'
-        }
-        
-        self.legitimate_domains = {
-            'zenithbank.com', 'facebook.com', 'google.com',
-            'gtbank.com', 'firstbanknigeria.com', 'accessbankplc.com'
-        }
+    kind = 'url'
+
+    def __init__(self, scam_domains=URL_SCAM_DOMAINS, legitimate_domains=URL_LEGITIMATE_DOMAINS,
+                 suspicious_tlds=URL_SUSPICIOUS_TLDS, ruleset_version='builtin', blocklist=None):
+        self.known_scam_domains = DomainTrie(scam_domains)
+        # Optional MappedBlocklist for lists too large to hold in every worker
+        self.blocklist = blocklist
+        self.legitimate_domains = DomainTrie(legitimate_domains)
+        self.suspicious_tlds = DomainTrie(suspicious_tlds)
+        self.ruleset_version = ruleset_version
+        # Hashing millions of domains per reload isn't worth it; a swap flushes the verdict cache anyway
+        self.version = rules_digest(
+            'url', ruleset_version, len(self.known_scam_domains),
+            len(self.legitimate_domains), sorted(suspicious_tlds),
+            blocklist.path if blocklist is not None else None,
+            len(blocklist) if blocklist is not None else 0
+        )
 
     def scan_url(self, url):
         """Simple URL scanner without complex fraud detection"""
         try:
-            # Normalize URL
-            normalized_url = url.lower().strip()
-            if not normalized_url.startswith(('http://', 'https://')):
-                normalized_url = 'http://' + normalized_url
-            
             # Extract domain
-            domain = self.extract_domain(normalized_url)
+            domain = self.extract_domain(url)
+            result = {'domain': domain, 'ruleset_version': self.ruleset_version}
+            if not domain:
+                result.update({
+                    'message': '❌ Invalid URL - no host name found',
+                    'type': 'error'
+                })
+                return result
             
-            # Check against known lists
-            if domain in self.known_scam_domains:
-                return {
+            # Check the host and every parent domain against known lists
+            matched = self.known_scam_domains.match(domain)
+            if not matched and self.blocklist is not None:
+                matched = self.blocklist.match(domain)
+            if matched:
+                result.update({
                     'message': '🚨 HIGH RISK - Known scam domain',
-                    'type': 'scam'
-                }
+                    'type': 'scam',
+                    'matched': matched
+                })
+                return result
             
-            if domain in self.legitimate_domains:
-                return {
+            matched = self.legitimate_domains.match(domain)
+            if matched:
+                result.update({
                     'message': '✅ SAFE - Legitimate website',
-                    'type': 'safe'
-                }
+                    'type': 'safe',
+                    'matched': matched
+                })
+                return result
             
             # Basic pattern checks
-            suspicious_tlds = ['.tk', '.ml', '.ga', '.cf', '.xyz', '.top', '.club', '.site', '.online']
-            if any(domain.endswith(tld) for tld in suspicious_tlds):
-                return {
+            matched = self.suspicious_tlds.match(domain)
+            if matched:
+                result.update({
                     'message': '⚠️ WARNING - Suspicious domain characteristics',
-                    'type': 'warning'
-                }
+                    'type': 'warning',
+                    'matched': matched
+                })
+                return result
             
-            return {
+            result.update({
                 'message': '✅ Likely safe - No major issues detected',
                 'type': 'safe'
-            }
+            })
+            return result
                 
         except Exception as e:
             logger.error(f"Error scanning URL: {e}")
             return {
                 'message': '❌ Scan failed - Please try again',
-                'type': 'error'
+                'type': 'error',
+                'ruleset_version': self.ruleset_version
             }
 
     def extract_domain(self, url):
         """Extract domain from URL"""
+        return url_host(url)
+
+    def normalize(self, url):
+        """The verdict depends only on the host, so that is the cache key"""
+        return self.extract_domain(url)
+
+    def check(self, url):
+        return self.scan_url(url)
+
+# =============================================
+# KEYWORD AUTOMATON
+# =============================================
+
+class KeywordAutomaton:
+    """Aho-Corasick matcher reporting every keyword hit in one pass over the text"""
+
+    def __init__(self, keywords):
+        self.keywords = sorted({kw for kw in keywords if kw})
+        self.accelerated = ahocorasick is not None
+        if self.accelerated:
+            self._automaton = ahocorasick.Automaton()
+            for kw in self.keywords:
+                self._automaton.add_word(kw, kw)
+            if self.keywords:
+                self._automaton.make_automaton()
+        else:
+            self._build()
+
+    def _build(self):
+        """Build the goto trie, failure links and merged outputs"""
+        goto, fail, out = [{}], [0], [()]
+        for kw in self.keywords:
+            state = 0
+            for ch in kw:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    fail.append(0)
+                    out.append(())
+                state = nxt
+            out[state] = out[state] + (kw,)
+
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def find_all(self, text):
+        """Return (start, keyword) for every occurrence, overlaps included"""
+        if not self.keywords:
+            return []
+        if self.accelerated:
+            return [(end - len(kw) + 1, kw) for end, kw in self._automaton.iter(text)]
+
+        goto, fail, out = self._goto, self._fail, self._out
+        hits = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for kw in out[state]:
+                    hits.append((i - len(kw) + 1, kw))
+        return hits
+
+    def matches(self, text):
+        """Return the set of distinct keywords present in the text"""
+        return {kw for _, kw in self.find_all(text)}
+
+    def __len__(self):
+        return len(self.keywords)
+
+def score_verdict(verdicts, score):
+    """Map a risk score to (type, message) using thresholds sorted high to low"""
+    for threshold, result_type, message in verdicts:
+        if score >= threshold:
+            return result_type, message
+    return verdicts[-1][1], verdicts[-1][2]
+
+def rules_digest(*tables):
+    """Short digest identifying the contents of a set of rule tables"""
+    payload = json.dumps(tables, sort_keys=True, default=sorted, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+
+# =============================================
+# USSD RULE ENGINE
+# =============================================
+
+USSD_SAFE_CODES = frozenset([
+    '*901#', '*894#', '*737#', '*919#', '*822#', '*533#',
+    '*322#', '*326#', '*779#', '*989#', '*123#', '*500#',
+    '*955#', '*833#', '*706#', '*909#', '*966#', '*482#'
+])
+
+USSD_INDICATORS = {
+    'password': 10, 'pin': 10, 'bvn': 15, 'winner': 12, 'won': 12,
+    'prize': 12, 'lottery': 12, 'claim': 10, 'verification': 8
+}
+
+USSD_VERDICTS = [
+    (20, 'scam', '🚨 EXTREME RISK - USSD SCAM DETECTED! Do not dial!'),
+    (15, 'scam', '🚨 HIGH RISK - Likely fraudulent USSD code'),
+    (10, 'warning', '⚠️ SUSPICIOUS - Verify with your bank before using'),
+    (5, 'warning', '⚠️ CAUTION - Unknown USSD code, use carefully'),
+    (0, 'safe', '✅ Likely safe USSD code'),
+]
+
+class USSDRuleEngine:
+    """USSD safe-code lookup plus keyword indicators matched by one automaton"""
+
+    kind = 'ussd'
+
+    def __init__(self, safe_codes=USSD_SAFE_CODES, indicators=USSD_INDICATORS, verdicts=USSD_VERDICTS,
+                 ruleset_version='builtin'):
+        self.safe_codes = frozenset(safe_codes)
+        self.indicators = dict(indicators)
+        self.verdicts = sorted(verdicts, key=lambda v: v[0], reverse=True)
+        self.automaton = KeywordAutomaton(self.indicators)
+        self.ruleset_version = ruleset_version
+        self.version = rules_digest(ruleset_version, self.safe_codes, self.indicators, self.verdicts)
+
+    def normalize(self, code):
+        """Safe codes are matched exactly, so a code is its own cache key"""
+        return code
+
+    def check(self, code):
+        """Score a USSD code and return the verdict payload"""
+        if code in self.safe_codes:
+            return {
+                'message': '✅ SAFE - Verified Nigerian bank USSD code',
+                'type': 'safe',
+                'risk_score': 0,
+                'reasons': [],
+                'ruleset_version': self.ruleset_version
+            }
+
+        found = self.automaton.matches(code.lower())
+        reasons = [kw for kw in self.indicators if kw in found]
+        score = sum(self.indicators[kw] for kw in reasons)
+        result_type, message = score_verdict(self.verdicts, score)
+        return {
+            'message': message,
+            'type': result_type,
+            'risk_score': score,
+            'reasons': reasons,
+            'ruleset_version': self.ruleset_version
+        }
+
+# =============================================
+# SMS RULE ENGINE
+# =============================================
+
+# Ordered (pattern, points, anchors) rules; weights match the original inline checks.
+# Every match of a rule contains one of its anchor keywords, so rules whose
+# anchors are absent are skipped without running the regex.
+SMS_RULES = [
+    (r'won\s*\d+[,.]?\d*\s*(million|thousand|billion)', 15, ('won',)),
+    (r'congratulation(s)?!*\s*you\s+(won|have|are)', 12, ('congratulation',)),
+    (r'prize\s*(money|award|winner)', 10, ('prize',)),
+    (r'lottery|jackpot|raffle', 10, ('lottery', 'jackpot', 'raffle')),
+    (r'claim\s*(your|this|now)', 8, ('claim',)),
+    (r'free\s*(money|airtime|data|gift)', 8, ('free',)),
+    (r'account\s*verification', 7, ('account',)),
+    (r'password\s*reset', 7, ('password',)),
+    (r'bvn\s*(verification|update)', 15, ('bvn',)),
+    (r'atm\s*card\s*(details|pin)', 15, ('atm',)),
+    (r'click\s*(link|here|below)', 6, ('click',)),
+    (r'http[s]?://|www\.|bit\.ly', 8, ('http', 'www.', 'bit.ly')),
+    (r'call\s*0[7-9][0-9]{8,}', 7, ('call',)),
+    (r'urgent|immediate|action\s*required', 5, ('urgent', 'immediate', 'action')),
+]
+
+# (minimum score, type, message), checked from the highest threshold down
+SMS_VERDICTS = [
+    (25, 'scam', '🚨 EXTREME RISK - NIGERIAN ADVANCE FEE SCAM DETECTED!'),
+    (18, 'scam', '🚨 HIGH-RISK SCAM - Likely financial fraud attempt'),
+    (12, 'warning', '⚠️ SUSPICIOUS - Potential phishing attempt'),
+    (8, 'warning', '⚠️ CAUTION - Some suspicious elements detected'),
+    (0, 'safe', '✅ Likely legitimate message'),
+]
+
+class SMSRuleEngine:
+    """SMS rules compiled once at import, prefiltered by a keyword automaton"""
+
+    kind = 'sms'
+
+    def __init__(self, rules=SMS_RULES, verdicts=SMS_VERDICTS, ruleset_version='builtin'):
+        self.rules = [
+            # Anchors are compared against casefolded text, so fold them the same way
+            (pattern[:30], re.compile(pattern, re.IGNORECASE), points,
+             frozenset(anchor.casefold() for anchor in anchors if anchor))
+            for pattern, points, anchors in rules
+        ]
+        self.verdicts = sorted(verdicts, key=lambda v: v[0], reverse=True)
+        self.automaton = KeywordAutomaton(
+            anchor for *_, anchors in self.rules for anchor in anchors
+        )
+        self.ruleset_version = ruleset_version
+        self.version = rules_digest(ruleset_version, rules, self.verdicts)
+
+    def normalize(self, text):
+        """Rules only ever see the lowercased message"""
+        return text.lower()
+
+    def scan(self, text):
+        """Return (reason, points, span) for every rule matching the text"""
+        text = self.normalize(text)
+        # casefold catches the few characters IGNORECASE folds but lower() keeps
+        found = self.automaton.matches(text.casefold())
+        hits = []
+        for reason, regex, points, anchors in self.rules:
+            if anchors and anchors.isdisjoint(found):
+                continue
+            match = regex.search(text)
+            if match:
+                hits.append((reason, points, match.span()))
+        return hits
+
+    def verdict(self, score):
+        """Map a risk score to its (type, message) verdict"""
+        return score_verdict(self.verdicts, score)
+
+    def check(self, text):
+        """Score an SMS and return the verdict payload"""
+        hits = self.scan(text)
+        score = sum(points for _, points, _ in hits)
+        result_type, message = self.verdict(score)
+        return {
+            'message': message,
+            'type': result_type,
+            'risk_score': score,
+            'reasons': [reason for reason, _, _ in hits],
+            'ruleset_version': self.ruleset_version
+        }
+
+# =============================================
+# VERDICT CACHE
+# =============================================
+
+class VerdictCache:
+    """Bounded, TTL'd LRU of scanner verdicts.
+
+    Keys are a digest of the engine kind, its ruleset version and the normalized
+    input, so verdicts from an older ruleset are never served. Only scoring is
+    cached; callers still authenticate and debit quota on every request.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, enabled=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()  # digest -> (verdict, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    @staticmethod
+    def key(engine, text):
+        raw = f"{engine.kind}\0{engine.version}\0{engine.normalize(text)}"
+        return hashlib.sha256(raw.encode('utf-8')).digest()
+
+    def check(self, engine, text):
+        """Return engine.check(text), scoring only on a miss"""
+        if not self.enabled:
+            return engine.check(text)
+        key = self.key(engine, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry[0])
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+
+        verdict = engine.check(text)
+        if verdict.get('type') == 'error':
+            # A failed scan may succeed next time; don't pin the failure
+            return dict(verdict)
+        with self._lock:
+            self._entries[key] = (verdict, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return dict(verdict)
+
+    def clear(self):
+        """Drop every verdict, e.g. after the rules change"""
+        with self._lock:
+            self._entries.clear()
+            self.flushes += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None
+        }
+
+verdict_cache = VerdictCache(
+    max_size=int(os.environ.get('VERDICT_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('VERDICT_CACHE_TTL_SECONDS', 3600)),
+    enabled=os.environ.get('VERDICT_CACHE_ENABLED', 'true').lower() == 'true'
+)
+
+# =============================================
+# SCANNER RULESET
+# =============================================
+
+def builtin_ruleset():
+    """The built-in rule tables in the scanner_rules.json layout"""
+    return {
+        'version': 'builtin',
+        'sms': {
+            'rules': [
+                {'pattern': pattern, 'points': points, 'anchors': list(anchors)}
+                for pattern, points, anchors in SMS_RULES
+            ],
+            'verdicts': [
+                {'min_score': threshold, 'type': result_type, 'message': message}
+                for threshold, result_type, message in SMS_VERDICTS
+            ]
+        },
+        'ussd': {
+            'safe_codes': sorted(USSD_SAFE_CODES),
+            'indicators': dict(USSD_INDICATORS),
+            'verdicts': [
+                {'min_score': threshold, 'type': result_type, 'message': message}
+                for threshold, result_type, message in USSD_VERDICTS
+            ]
+        },
+        'url': {
+            'scam_domains': sorted(URL_SCAM_DOMAINS),
+            'legitimate_domains': sorted(URL_LEGITIMATE_DOMAINS),
+            'suspicious_tlds': list(URL_SUSPICIOUS_TLDS),
+            # Optional path to a compiled MappedBlocklist (see `flask build-blocklist`)
+            'blocklist': None
+        }
+    }
+
+class Ruleset:
+    """Immutable bundle of compiled scanner engines; replaced wholesale, never mutated"""
+
+    def __init__(self, version, sms, ussd, url, source):
+        self.version = version
+        self.sms = sms
+        self.ussd = ussd
+        self.url = url
+        self.source = source
+        self.loaded_at = datetime.now().isoformat()
+
+    @classmethod
+    def from_dict(cls, data, source='builtin'):
+        """Compile a ruleset document; raises on any malformed rule"""
+        version = str(data['version'])
+        sms = SMSRuleEngine(
+            rules=[
+                (rule['pattern'], int(rule['points']), tuple(rule.get('anchors', ())))
+                for rule in data['sms']['rules']
+            ],
+            verdicts=cls._verdicts(data['sms']),
+            ruleset_version=version
+        )
+        ussd = USSDRuleEngine(
+            safe_codes=data['ussd']['safe_codes'],
+            indicators={kw.lower(): int(points) for kw, points in data['ussd']['indicators'].items()},
+            verdicts=cls._verdicts(data['ussd']),
+            ruleset_version=version
+        )
+        blocklist = data['url'].get('blocklist')
+        if blocklist:
+            # Relative paths are resolved next to the rules file
+            base = os.path.dirname(os.path.abspath(source if source != 'builtin' else __file__))
+            blocklist = MappedBlocklist(os.path.join(base, blocklist))
+        url = SimpleScanner(
+            scam_domains=data['url']['scam_domains'],
+            legitimate_domains=data['url']['legitimate_domains'],
+            suspicious_tlds=data['url']['suspicious_tlds'],
+            ruleset_version=version,
+            blocklist=blocklist or None
+        )
+        return cls(version, sms, ussd, url, source)
+
+    @staticmethod
+    def _verdicts(section):
+        return [(int(v['min_score']), v['type'], v['message']) for v in section['verdicts']]
+
+class ScannerRules:
+    """Holds the active Ruleset and swaps in a new one when the rules file changes.
+
+    Requests read `current()` without taking a lock: a reload compiles the new
+    ruleset off to the side and replaces the reference in one assignment, so a
+    request sees either the old rules or the new ones, never a mix. A file that
+    fails to load leaves the running ruleset in place. The polled signature
+    covers the compiled blocklist the rules point at as well, so swapping in a
+    rebuilt one (`flask build-blocklist` replaces the file) is picked up too.
+    """
+
+    def __init__(self, path, reload_interval=30):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._active = Ruleset.from_dict(builtin_ruleset())
+        self._signature = None
+        self._checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+        if os.path.exists(path):
+            self.reload()
+
+    def current(self):
+        if self.reload_interval and time.monotonic() - self._checked_at >= self.reload_interval:
+            self._poll()
+        return self._active
+
+    def _poll(self):
+        """Reload if the file changed; skipped while another thread is already reloading"""
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            blocklist = self._active.url.blocklist
+            try:
+                signature = (os.stat(self.path).st_mtime_ns,)
+                if blocklist is not None:
+                    st = os.stat(blocklist.path)
+                    signature += (st.st_ino, st.st_mtime_ns)
+            except FileNotFoundError:
+                return
+            if signature != self._signature:
+                self._load()
+        finally:
+            self._reload_lock.release()
+
+    def reload(self):
+        with self._reload_lock:
+            return self._load()
+
+    def _load(self):
         try:
-            # Remove protocol and path
-            domain = url.split('//')[-1].split('/')[0]
-            # Remove www prefix
-            if domain.startswith('www.'):
-                domain = domain[4:]
-            return domain
-        except:
-            return url
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, encoding='utf-8') as f:
+                ruleset = Ruleset.from_dict(json.load(f), source=self.path)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"❌ Failed to load scanner rules from {self.path}: {e}")
+            return False
+
+        previous = self._active.version
+        # Rules mtime plus the inode/mtime of the blocklist that was mapped
+        blocklist = ruleset.url.blocklist
+        self._signature = (mtime,) + (blocklist.identity if blocklist is not None else ())
+        self._active = ruleset
+        self.reloads += 1
+        # Keyed by version already; flushing just frees the old entries now
+        verdict_cache.clear()
+        logger.info(f"📜 Scanner rules {previous} -> {ruleset.version} from {self.path}")
+        return True
 
-# Initialize scanner
-scanner = SimpleScanner()
+    def stats(self):
+        ruleset = self._active
+        return {
+            'version': ruleset.version,
+            'source': ruleset.source,
+            'loaded_at': ruleset.loaded_at,
+            'url_blocklist_entries': len(ruleset.url.blocklist) if ruleset.url.blocklist is not None else None,
+            'reload_interval_seconds': self.reload_interval,
+            'reloads': self.reloads,
+            'failures': self.failures
+        }
+
+scanner_rules = ScannerRules(
+    path=os.environ.get('SCANNER_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scanner_rules.json')),
+    reload_interval=float(os.environ.get('SCANNER_RULES_RELOAD_SECONDS', 30))
+)
 
 # =============================================
 # FLASK ROUTES
@@ -2465,65 +5441,22 @@ def api_check_ussd():
                 'needs_verification': True
             })
         
-        # Check free limit
-        if not user['is_premium'] and not UserManager.can_make_free_check(user):
+        # Check free limit and count this check in one atomic update
+        if not UserManager.consume_check(user):
             return jsonify({
                 'message': '❌ FREE LIMIT REACHED! Upgrade to Premium for unlimited checks.',
                 'type': 'warning',
                 'limit_reached': True
             })
         
-        UserManager.record_check(user)
-        
         # USSD fraud detection logic
-        safe_bank_codes = [
-            '*901#', '*894#', '*737#', '*919#', '*822#', '*533#', 
-            '*322#', '*326#', '*779#', '*989#', '*123#', '*500#',
-            '*955#', '*833#', '*706#', '*909#', '*966#', '*482#'
-        ]
-        
-        scam_indicators = {
-            'password': 10, 'pin': 10, 'bvn': 15, 'winner': 12, 'won': 12,
-            'prize': 12, 'lottery': 12, 'claim': 10, 'verification': 8
-        }
-        
-        risk_score = 0
-        detected_patterns = []
-        
-        code_lower = code.lower()
-        
-        # Check against safe codes
-        if code in safe_bank_codes:
-            message = '✅ SAFE - Verified Nigerian bank USSD code'
-            result_type = 'safe'
-        else:
-            # Check for scam indicators
-            for indicator, points in scam_indicators.items():
-                if indicator in code_lower:
-                    risk_score += points
-                    detected_patterns.append(indicator)
-            
-            # Risk assessment
-            if risk_score >= 20:
-                message = '🚨 EXTREME RISK - USSD SCAM DETECTED! Do not dial!'
-                result_type = 'scam'
-            elif risk_score >= 15:
-                message = '🚨 HIGH RISK - Likely fraudulent USSD code'
-                result_type = 'scam'
-            elif risk_score >= 10:
-                message = '⚠️ SUSPICIOUS - Verify with your bank before using'
-                result_type = 'warning'
-            elif risk_score >= 5:
-                message = '⚠️ CAUTION - Unknown USSD code, use carefully'
-                result_type = 'warning'
-            else:
-                message = '✅ Likely safe USSD code'
-                result_type = 'safe'
+        result = verdict_cache.check(scanner_rules.current().ussd, code)
         
         return jsonify({
             'success': True,
-            'message': message,
-            'type': result_type
+            'message': result['message'],
+            'type': result['type'],
+            'ruleset_version': result['ruleset_version']
         })
     except Exception as e:
         logger.error(f"USSD check error: {e}")
@@ -2552,70 +5485,186 @@ def api_check_sms():
                 'needs_verification': True
             })
         
-        # Check free limit
-        if not user['is_premium'] and not UserManager.can_make_free_check(user):
+        # Check free limit and count this check in one atomic update
+        if not UserManager.consume_check(user):
             return jsonify({
                 'message': '❌ FREE LIMIT REACHED! Upgrade to Premium for unlimited scans.',
                 'type': 'warning',
                 'limit_reached': True
             })
         
-        UserManager.record_check(user)
-        
         # SMS fraud detection logic
-        sms_lower = sms.lower()
-        score = 0
-        reasons = []
-        
-        high_risk_patterns = {
-            r'won\s*\d+[,.]?\d*\s*(million|thousand|billion)': 15,
-            r'congratulation(s)?!*\s*you\s+(won|have|are)': 12,
-            r'prize\s*(money|award|winner)': 10,
-            r'lottery|jackpot|raffle': 10,
-            r'claim\s*(your|this|now)': 8,
-            r'free\s*(money|airtime|data|gift)': 8,
-            r'account\s*verification': 7,
-            r'password\s*reset': 7,
-            r'bvn\s*(verification|update)': 15,
-            r'atm\s*card\s*(details|pin)': 15,
-            r'click\s*(link|here|below)': 6,
-            r'http[s]?://|www\.|bit\.ly': 8,
-            r'call\s*0[7-9][0-9]{8,}': 7,
-            r'urgent|immediate|action\s*required': 5
-        }
-        
-        for pattern, points in high_risk_patterns.items():
-            if re.search(pattern, sms_lower, re.IGNORECASE):
-                score += points
-                reasons.append(pattern[:30])
-        
-        # Risk assessment
-        if score >= 25:
-            message = '🚨 EXTREME RISK - NIGERIAN ADVANCE FEE SCAM DETECTED!'
-            result_type = 'scam'
-        elif score >= 18:
-            message = '🚨 HIGH-RISK SCAM - Likely financial fraud attempt'
-            result_type = 'scam'
-        elif score >= 12:
-            message = '⚠️ SUSPICIOUS - Potential phishing attempt'
-            result_type = 'warning'
-        elif score >= 8:
-            message = '⚠️ CAUTION - Some suspicious elements detected'
-            result_type = 'warning'
-        else:
-            message = '✅ Likely legitimate message'
-            result_type = 'safe'
+        result = verdict_cache.check(scanner_rules.current().sms, sms)
         
         return jsonify({
             'success': True,
-            'message': message,
-            'type': result_type,
-            'risk_score': score
+            'message': result['message'],
+            'type': result['type'],
+            'risk_score': result['risk_score'],
+            'ruleset_version': result['ruleset_version']
         })
     except Exception as e:
         logger.error(f"SMS check error: {e}")
         return jsonify({'success': False, 'message': 'Server error during SMS check'})
 
+@app.route('/api/check-url', methods=['POST'])
+def api_check_url():
+    try:
+        data = request.get_json()
+        url = data.get('url', '').strip()
+        user_id = data.get('user_id')
+        
+        if not user_id:
+            return jsonify({'success': False, 'message': 'User ID is required'})
+        
+        # Reject unparseable input before it costs the user a check
+        url_scanner = scanner_rules.current().url
+        if not url_scanner.extract_domain(url):
+            return jsonify({'success': False, 'message': 'Please enter a valid URL or domain'})
+        
+        user = UserManager.get_user(user_id)
+        if not user:
+            return jsonify({'success': False, 'message': 'User not found'})
+        
+        # Enforce email verification
+        if not user.get('is_verified', False):
+            return jsonify({
+                'success': False,
+                'message': '❌ Please verify your email first to use security scanner.',
+                'type': 'warning',
+                'needs_verification': True
+            })
+        
+        # URL reputation lookup; a scan that fails doesn't cost the user a check
+        result = verdict_cache.check(url_scanner, url)
+        if result['type'] == 'error':
+            return jsonify({
+                'success': False,
+                'message': result['message'],
+                'type': result['type']
+            })
+        
+        # Check free limit and count this check in one atomic update
+        if not UserManager.consume_check(user):
+            return jsonify({
+                'message': '❌ FREE LIMIT REACHED! Upgrade to Premium for unlimited scans.',
+                'type': 'warning',
+                'limit_reached': True
+            })
+        
+        return jsonify({
+            'success': True,
+            'message': result['message'],
+            'type': result['type'],
+            'domain': result.get('domain'),
+            'matched': result.get('matched'),
+            'ruleset_version': result['ruleset_version']
+        })
+    except Exception as e:
+        logger.error(f"URL check error: {e}")
+        return jsonify({'success': False, 'message': 'Server error during URL check'})
+
+def stream_batch_scan(kind, label):
+    """Authenticate and debit quota once, then stream one NDJSON verdict per item"""
+    try:
+        data = request.get_json(silent=True) or {}
+    except RequestEntityTooLarge:
+        response = jsonify({
+            'success': False,
+            'message': 'Request too large',
+            'max_bytes': app.config['MAX_CONTENT_LENGTH']
+        })
+        response.status_code = 413
+        return response
+    items = data.get('items')
+    user_id = data.get('user_id')
+    
+    if not user_id:
+        return jsonify({'success': False, 'message': 'User ID is required'})
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'items must be a non-empty list'})
+    
+    if len(items) > SCAN_BATCH_MAX:
+        return jsonify({
+            'success': False,
+            'message': f'Too many items - at most {SCAN_BATCH_MAX} per batch',
+            'max_items': SCAN_BATCH_MAX
+        })
+    
+    if not all(isinstance(item, str) for item in items):
+        return jsonify({'success': False, 'message': 'Every item must be a string'})
+    
+    too_long = next((index for index, item in enumerate(items) if len(item) > SCAN_ITEM_MAX_CHARS), None)
+    if too_long is not None:
+        return jsonify({
+            'success': False,
+            'message': f'Item {too_long} is too long - at most {SCAN_ITEM_MAX_CHARS} characters',
+            'max_item_chars': SCAN_ITEM_MAX_CHARS
+        })
+    
+    user = UserManager.get_user(user_id)
+    if not user:
+        return jsonify({'success': False, 'message': 'User not found'})
+    
+    # Enforce email verification
+    if not user.get('is_verified', False):
+        return jsonify({
+            'success': False,
+            'message': '❌ Please verify your email first to use security scanner.',
+            'type': 'warning',
+            'needs_verification': True
+        })
+    
+    # The whole batch counts against the free limit in one atomic update
+    if not UserManager.consume_check(user, amount=len(items)):
+        return jsonify({
+            'message': '❌ FREE LIMIT REACHED! Not enough free checks left for this batch. Upgrade to Premium for unlimited scans.',
+            'type': 'warning',
+            'limit_reached': True,
+            'batch_size': len(items)
+        })
+    
+    # The whole batch is scored by one ruleset even if a reload lands mid-stream
+    engine = getattr(scanner_rules.current(), kind)
+    
+    def generate():
+        for index, item in enumerate(items):
+            try:
+                result = verdict_cache.check(engine, item.strip())
+                line = {
+                    'index': index,
+                    'success': True,
+                    'message': result['message'],
+                    'type': result['type'],
+                    'risk_score': result['risk_score'],
+                    'ruleset_version': result['ruleset_version']
+                }
+            except Exception as e:
+                logger.error(f"{label} batch item {index} error: {e}")
+                line = {'index': index, 'success': False, 'message': f'Server error during {label} check'}
+            yield json.dumps(line) + '\n'
+        yield json.dumps({'done': True, 'count': len(items)}) + '\n'
+    
+    logger.info(f"📦 {label} batch of {len(items)} for user {user_id}")
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/check-sms/batch', methods=['POST'])
+def api_check_sms_batch():
+    try:
+        return stream_batch_scan('sms', 'SMS')
+    except Exception as e:
+        logger.error(f"SMS batch check error: {e}")
+        return jsonify({'success': False, 'message': 'Server error during SMS batch check'})
+
+@app.route('/api/check-ussd/batch', methods=['POST'])
+def api_check_ussd_batch():
+    try:
+        return stream_batch_scan('ussd', 'USSD')
+    except Exception as e:
+        logger.error(f"USSD batch check error: {e}")
+        return jsonify({'success': False, 'message': 'Server error during USSD batch check'})
+
 # =============================================
 # AUTHENTICATION API ENDPOINTS
 # =============================================
@@ -2644,18 +5693,18 @@ def api_register_user():
             return jsonify({'success': False, 'message': error})
         
         # Generate and send OTP
-        if OTPManager.generate_and_send_otp(email):
+        email_id = OTPManager.generate_and_send_otp(email)
+        if email_id:
             return jsonify({
                 'success': True,
                 'message': 'Registration successful! OTP sent to your email.',
-                'user_id': user['id']
+                'user_id': user['id'],
+                'email_id': email_id
             })
         else:
             # Check if email configuration is missing
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            if not sender_email or not sender_password:
-                logger.error("Email configuration missing - check SMTP_EMAIL and SMTP_PASSWORD environment variables")
+            if not EmailService.is_configured():
+                logger.error("Email configuration missing - check SENDER_EMAIL and EMAIL_PASSWORD environment variables")
                 return jsonify({
                     'success': False,
                     'message': 'Email service configuration error. Please contact administrator.'
@@ -2684,7 +5733,8 @@ def api_verify_otp():
             # Find user by email and mark as verified
             user = UserManager.get_user_by_email(email)
             if user:
-                UserManager.verify_user_email(user['id'])
+                if not UserManager.verify_user_email(user['id']):
+                    return jsonify({'success': False, 'message': 'Failed to verify email. Please try again.'})
                 
                 # Create session after verification
                 session_token = AuthManager.create_session(user['id'])
@@ -2722,16 +5772,16 @@ def api_send_verification_otp():
             return jsonify({'success': False, 'message': 'Email is already verified'})
         
         # Generate and send OTP
-        if OTPManager.generate_and_send_otp(email):
+        email_id = OTPManager.generate_and_send_otp(email)
+        if email_id:
             return jsonify({
                 'success': True,
-                'message': 'OTP sent to your email!'
+                'message': 'OTP sent to your email!',
+                'email_id': email_id
             })
         else:
             # Check if email configuration is missing
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            if not sender_email or not sender_password:
+            if not EmailService.is_configured():
                 return jsonify({
                     'success': False,
                     'message': 'Email service not configured. Please contact administrator.'
@@ -2754,13 +5804,12 @@ def api_resend_otp():
         if not email:
             return jsonify({'success': False, 'message': 'Email is required'})
         
-        if OTPManager.generate_and_send_otp(email):
-            return jsonify({'success': True, 'message': 'New OTP sent to your email'})
+        email_id = OTPManager.generate_and_send_otp(email)
+        if email_id:
+            return jsonify({'success': True, 'message': 'New OTP sent to your email', 'email_id': email_id})
         else:
             # Check if email configuration is missing
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            if not sender_email or not sender_password:
+            if not EmailService.is_configured():
                 return jsonify({
                     'success': False,
                     'message': 'Email service not configured. Please contact administrator.'
@@ -2771,6 +5820,22 @@ def api_resend_otp():
         logger.error(f"Resend OTP error: {e}")
         return jsonify({'success': False, 'message': 'Server error'})
 
+@app.route('/api/email-status', methods=['GET'])
+def api_email_status():
+    try:
+        email_id = request.args.get('email_id')
+        if not email_id:
+            return jsonify({'success': False, 'message': 'Email ID is required'})
+        
+        status = email_outbox.status(email_id)
+        if not status:
+            return jsonify({'success': False, 'message': 'Email not found'})
+        
+        return jsonify(dict(status, success=True))
+    except Exception as e:
+        logger.error(f"Email status error: {e}")
+        return jsonify({'success': False, 'message': 'Server error'})
+
 @app.route('/api/login-user', methods=['POST'])
 def api_login_user():
     try:
@@ -2870,9 +5935,7 @@ def api_forgot_password():
             })
         else:
             # Check if email configuration is missing
-            sender_email = EMAIL_CONFIG['sender_email']
-            sender_password = EMAIL_CONFIG['sender_password']
-            if not sender_email or not sender_password:
+            if not EmailService.is_configured():
                 return jsonify({
                     'success': False,
                     'message': 'Email service not configured. Please contact administrator.'
@@ -2903,28 +5966,13 @@ def api_reset_password():
         if len(new_password) < 6:
             return jsonify({'success': False, 'message': 'Password must be at least 6 characters long'})
         
-        # Find user by reset token
-        users = UserManager.get_all_users()
-        user_email = None
-        for user in users.values():
-            if 'reset_tokens' in user:
-                for reset_token in user['reset_tokens']:
-                    if (reset_token['token'] == token and 
-                        not reset_token['used'] and 
-                        datetime.now() < datetime.fromisoformat(reset_token['expires_at'])):
-                        user_email = user['email']
-                        break
-            if user_email:
-                break
-        
+        # One indexed lookup that also marks the token used, so a link can't be redeemed twice
+        user_email = UserManager.redeem_reset_token(token)
         if not user_email:
             return jsonify({'success': False, 'message': 'Invalid or expired reset token'})
         
         # Update password
         if UserManager.update_password(user_email, new_password):
-            # Mark token as used
-            UserManager.use_reset_token(user_email, token)
-            
             return jsonify({
                 'success': True,
                 'message': 'Password reset successfully! You can now login with your new password.'
@@ -3085,16 +6133,18 @@ def api_admin_verify_payment():
         if not payment:
             return jsonify({'success': False, 'message': 'Payment not found'})
         
-        # Mark payment as verified
-        PaymentManager.update_payment(payment_id, {
+        # Both writes land before answering; if premium can't be saved the payment goes back
+        previous = {'status': payment.get('status'), 'verified_at': payment.get('verified_at')}
+        if not PaymentManager.update_payment(payment_id, {
             'status': 'verified',
             'verified_at': datetime.now().isoformat()
-        })
+        }, sync=True):
+            return jsonify({'success': False, 'message': 'Failed to verify payment'})
         
-        # Activate premium for user
         user = UserManager.get_user(payment['user_id'])
-        if user:
-            UserManager.activate_premium(user, payment['plan_type'])
+        if user and not UserManager.activate_premium(user, payment['plan_type']):
+            PaymentManager.update_payment(payment_id, previous, sync=True)
+            return jsonify({'success': False, 'message': 'Failed to activate premium'})
         
         return jsonify({
             'success': True,
@@ -3116,7 +6166,8 @@ def api_admin_activate_premium():
             return jsonify({'success': False, 'message': 'User not found'})
         
         # Activate premium
-        UserManager.activate_premium(user, plan_type)
+        if not UserManager.activate_premium(user, plan_type):
+            return jsonify({'success': False, 'message': 'Failed to activate premium'})
         
         return jsonify({
             'success': True,
@@ -3126,6 +6177,20 @@ def api_admin_activate_premium():
         logger.error(f"Admin activate premium error: {e}")
         return jsonify({'success': False, 'message': 'Server error'})
 
+@app.route('/api/admin/reload-rules', methods=['POST'])
+def api_admin_reload_rules():
+    try:
+        if not scanner_rules.reload():
+            return jsonify({
+                'success': False,
+                'message': 'Rules file could not be loaded - previous ruleset kept',
+                'rules': scanner_rules.stats()
+            })
+        return jsonify({'success': True, 'rules': scanner_rules.stats()})
+    except Exception as e:
+        logger.error(f"Admin reload rules error: {e}")
+        return jsonify({'success': False, 'message': 'Server error'})
+
 # =============================================
 # DEBUG & HEALTH CHECK ENDPOINTS
 # =============================================
@@ -3134,17 +6199,22 @@ def api_admin_activate_premium():
 def debug_db():
     """Test MongoDB connection"""
     try:
-        db = Database.get_db()
-        users_count = len(Database.load_users())
-        payments_count = len(Database.load_payments())
+        backend = Database.backend()
+        db = backend.db if isinstance(backend, MongoBackend) else None
+        users_count = Database.count('users')
+        payments_count = Database.count('payments')
         
         return jsonify({
             'success': True,
+            'storage_backend': backend.name,
             'mongodb_connected': db is not None,
             'total_users': users_count,
             'total_payments': payments_count,
-            'database_name': db.name if db else 'None',
-            'collections': db.list_collection_names() if db else [],
+            'database_name': db.name if db is not None else 'None',
+            'collections': db.list_collection_names() if db is not None else [],
+            'indexes': backend.index_status(),
+            'schema_version': backend.schema_version(),
+            'expected_schema_version': Database.SCHEMA_VERSION,
             'environment': 'production' if os.environ.get('MONGODB_URI') else 'development'
         })
     except Exception as e:
@@ -3156,7 +6226,26 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'version': '2.0.0'
+        'version': '2.0.0',
+        'database': {
+            'backend': STORAGE_BACKEND,
+            'connected': Database._db is not None,
+            'circuit': Database.breaker.status()
+        }
+    })
+
+@app.route('/api/metrics')
+def metrics():
+    """In-process cache counters for this instance"""
+    return jsonify({
+        'success': True,
+        'timestamp': datetime.now().isoformat(),
+        'user_cache': user_cache.stats(),
+        'verdict_cache': verdict_cache.stats(),
+        'scanner_rules': scanner_rules.stats(),
+        'touch_buffer': touch_buffer.stats(),
+        'email_outbox': email_outbox.stats(),
+        'smtp_pool': smtp_pool.stats()
     })
 
 # =============================================
@@ -3219,7 +6308,8 @@ def test_email():
     sender_password = EMAIL_CONFIG['sender_password']
     
     return jsonify({
-        'email_configured': bool(sender_email and sender_password),
+        'email_configured': EmailService.is_configured(),
+        'transport': email_transport.name,
         'sender_email_set': bool(sender_email),
         'sender_password_set': bool(sender_password),
         'sender_email': sender_email[:3] + '••••••' if sender_email else None
@@ -3257,6 +6347,47 @@ def test_mongo():
 def favicon():
     return '', 204
 
+# =============================================
+# CLI COMMANDS
+# =============================================
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create collections and indexes and record the schema version"""
+    backend = Database.backend()
+    if isinstance(backend, MemoryBackend):
+        raise SystemExit("❌ No persistent storage - check STORAGE_BACKEND / MONGODB_URI")
+    backend.migrate()
+    print(f"✅ {backend.name} schema at version {Database.SCHEMA_VERSION}: {backend.index_status()}")
+
+@app.cli.command('import-json')
+def import_json_command():
+    """Copy users.json, payments.json, sessions.json and otp_storage.json into the active backend"""
+    for collection_name in Database.COLLECTIONS:
+        path = f'{collection_name}.json'
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            docs = json.load(f)
+        result = Database.bulk_save(collection_name, docs)
+        print(f"📥 {collection_name}: {result.to_dict()}")
+
+@app.cli.command('export-rules')
+def export_rules_command():
+    """Write the built-in scanner rules to SCANNER_RULES_PATH as a starting point for edits"""
+    with open(scanner_rules.path, 'w', encoding='utf-8') as f:
+        json.dump(builtin_ruleset(), f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    print(f"✅ Built-in scanner rules written to {scanner_rules.path}")
+
+@app.cli.command('build-blocklist')
+@click.argument('output')
+@click.argument('sources', nargs=-1, required=True)
+def build_blocklist_command(output, sources):
+    """Compile plaintext domain lists (one domain, hosts entry or URL per line) into OUTPUT"""
+    count = build_blocklist(sources, output)
+    print(f"✅ {count} domains written to {output} - set url.blocklist in the rules file to use it")
+
 # =============================================
 # APPLICATION STARTUP
 # =============================================
@@ -3271,26 +6402,32 @@ if __name__ == '__main__':
     logger.info(f"🚀 Starting CyberGuard NG Server")
     logger.info(f"🌐 Environment: {'Vercel' if is_vercel else 'Local'}")
     
-    # Check MongoDB
-    logger.info("🔍 Checking MongoDB connection...")
-    db = Database.get_db()
-    
-    if db is not None:
-        logger.info(f"✅ MongoDB connected successfully!")
-        try:
-            logger.info(f"📊 Database: {db.name}")
-            logger.info(f"📁 Collections: {db.list_collection_names()}")
-        except:
-            pass
+    if STORAGE_BACKEND != 'mongodb':
+        backend = Database.backend()
+        logger.info(f"💽 Storage backend: {backend.name}")
+        logger.info(f"🗂️ Indexes: {backend.index_status()}")
     else:
-        logger.error("❌ MongoDB connection failed!")
-        if is_vercel:
-            logger.error("🚨 CRITICAL: MongoDB not working on Vercel")
-            logger.error("Check: 1) MONGODB_URI environment variable 2) MongoDB Atlas network access")
+        # Check MongoDB
+        logger.info("🔍 Checking MongoDB connection...")
+        db = Database.get_db()
+    
+        if db is not None:
+            logger.info(f"✅ MongoDB connected successfully!")
+            try:
+                logger.info(f"📊 Database: {db.name}")
+                logger.info(f"📁 Collections: {db.list_collection_names()}")
+                logger.info(f"🗂️ Indexes: {Database.index_status(db)}")
+            except:
+                pass
+        else:
+            logger.error("❌ MongoDB connection failed!")
+            if is_vercel:
+                logger.error("🚨 CRITICAL: MongoDB not working on Vercel")
+                logger.error("Check: 1) MONGODB_URI environment variable 2) MongoDB Atlas network access")
     
     # Check email
-    if EMAIL_CONFIG['sender_email'] and EMAIL_CONFIG['sender_password']:
-        logger.info(f"✅ Email configured")
+    if EmailService.is_configured():
+        logger.info(f"✅ Email configured ({email_transport.name} transport)")
     else:
         logger.warning("⚠️ Email not configured")
     
@@ -0,0 +1,33 @@
+# conftest.py
+import os
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+from app import Database, MemoryBackend, SQLiteBackend, user_cache
+
+BACKENDS = ('memory', 'sqlite')
+
+@contextmanager
+def storage_backend(kind):
+    """Point Database at a fresh memory or SQLite backend for the duration"""
+    original = Database.backend
+    if kind == 'sqlite':
+        backend = SQLiteBackend(os.path.join(tempfile.mkdtemp(), 'test.db'))
+    else:
+        backend = MemoryBackend()
+    Database.backend = staticmethod(lambda: backend)
+    user_cache.clear()
+    try:
+        yield backend
+    finally:
+        Database.backend = original
+        user_cache.clear()
+        if kind == 'sqlite':
+            backend.close()
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    with storage_backend(request.param) as backend:
+        yield backend
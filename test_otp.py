@@ -0,0 +1,74 @@
+# test_otp.py
+import threading
+from datetime import datetime, timedelta
+
+from app import Database, AuthManager
+from conftest import BACKENDS, storage_backend
+
+MAX_ATTEMPTS = 3
+
+def store_otp(email, code, expires_in=timedelta(minutes=10)):
+    Database.set_otp({
+        'otp_code': code,
+        'email': email,
+        'created_at': datetime.now().isoformat(),
+        'expires_at': datetime.utcnow() + expires_in,
+        'verified': False,
+        'attempts': 0
+    })
+
+def test_otp_single_use(backend):
+    store_otp('once@example.com', '123456')
+    assert Database.verify_otp('once@example.com', '123456', MAX_ATTEMPTS)
+    assert not Database.verify_otp('once@example.com', '123456', MAX_ATTEMPTS)
+    otp = Database.get_otp('once@example.com')
+    assert otp['verified'] is True and otp['otp_code'] is None
+
+    store_otp('late@example.com', '123456', expires_in=timedelta(seconds=-1))
+    assert not Database.verify_otp('late@example.com', '123456', MAX_ATTEMPTS)
+    assert not Database.verify_otp('nobody@example.com', '123456', MAX_ATTEMPTS)
+    print(f"✅ OTP codes verify once and not after expiry on {backend.name}")
+
+def test_otp_lockout(backend):
+    store_otp('guess@example.com', '123456')
+    for _ in range(MAX_ATTEMPTS):
+        assert not Database.verify_otp('guess@example.com', '000000', MAX_ATTEMPTS)
+    otp = Database.get_otp('guess@example.com')
+    assert otp['attempts'] == MAX_ATTEMPTS and otp['otp_code'] is None
+    # The right code no longer helps once the attempts are used up
+    assert not Database.verify_otp('guess@example.com', '123456', MAX_ATTEMPTS)
+
+    store_otp('close@example.com', '123456')
+    for _ in range(MAX_ATTEMPTS - 1):
+        Database.verify_otp('close@example.com', '000000', MAX_ATTEMPTS)
+    assert Database.verify_otp('close@example.com', '123456', MAX_ATTEMPTS)
+    print(f"✅ OTP locks after {MAX_ATTEMPTS} wrong attempts on {backend.name}")
+
+def test_reset_token_single_use(backend):
+    token_hash = AuthManager.hash_token(AuthManager.generate_reset_token())
+    Database.insert_reset_token({
+        'token_hash': token_hash,
+        'user_id': 'user_1',
+        'email': 'reset@example.com',
+        'created_at': datetime.utcnow(),
+        'expires_at': datetime.utcnow() + timedelta(hours=1),
+        'used': False
+    })
+    winners = []
+    threads = [threading.Thread(target=lambda: winners.append(Database.claim_reset_token(token_hash)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = [token for token in winners if token]
+    assert len(claimed) == 1 and claimed[0]['email'] == 'reset@example.com'
+    assert Database.get_reset_token(token_hash)['used'] is True
+    assert Database.claim_reset_token(token_hash) is None
+    print(f"✅ Reset tokens are claimed exactly once on {backend.name}")
+
+if __name__ == "__main__":
+    for kind in BACKENDS:
+        for test in (test_otp_single_use, test_otp_lockout, test_reset_token_single_use):
+            with storage_backend(kind) as backend:
+                test(backend)
@@ -0,0 +1,77 @@
+# test_quota.py
+from datetime import datetime, timedelta
+
+from app import Database, FREE_DAILY_CHECKS
+from conftest import BACKENDS, storage_backend
+
+def make_user(backend, user_id, **fields):
+    user = {
+        'id': user_id,
+        'email': f'{user_id}@example.com',
+        'is_premium': False,
+        'premium_until': None,
+        'premium_plan': None,
+        'checks_today': 0,
+        'last_check_date': str(datetime.now().date()),
+        'total_checks': 0
+    }
+    user.update(fields)
+    backend.insert_one('users', user_id, user)
+    return user
+
+def test_free_limit(backend):
+    make_user(backend, 'free')
+    results = [Database.consume_checks('free', FREE_DAILY_CHECKS)[0] for _ in range(FREE_DAILY_CHECKS + 2)]
+    assert results == [True] * FREE_DAILY_CHECKS + [False, False], results
+    doc = backend.find_one('users', 'free')
+    assert doc['checks_today'] == FREE_DAILY_CHECKS and doc['total_checks'] == FREE_DAILY_CHECKS
+
+    # A batch that would cross the limit is refused whole
+    make_user(backend, 'batch', checks_today=FREE_DAILY_CHECKS - 1)
+    allowed, fields = Database.consume_checks('batch', FREE_DAILY_CHECKS, 2)
+    assert not allowed and fields['checks_today'] == FREE_DAILY_CHECKS - 1
+    assert Database.consume_checks('missing', FREE_DAILY_CHECKS) == (False, None)
+    print(f"✅ Free limit enforced on {backend.name}")
+
+def test_new_day_resets(backend):
+    yesterday = str((datetime.now() - timedelta(days=1)).date())
+    make_user(backend, 'daily', checks_today=FREE_DAILY_CHECKS, last_check_date=yesterday, total_checks=40)
+    allowed, fields = Database.consume_checks('daily', FREE_DAILY_CHECKS)
+    assert allowed and fields['checks_today'] == 1 and fields['total_checks'] == 41
+    assert fields['last_check_date'] == str(datetime.now().date())
+    print(f"✅ Daily counter resets on a new day on {backend.name}")
+
+def test_premium_expiry(backend):
+    tomorrow = str((datetime.now() + timedelta(days=1)).date())
+    make_user(backend, 'premium', is_premium=True, premium_until=tomorrow,
+              premium_plan='weekly', checks_today=FREE_DAILY_CHECKS)
+    allowed, fields = Database.consume_checks('premium', FREE_DAILY_CHECKS)
+    assert allowed and 'is_premium' not in fields
+
+    yesterday = str((datetime.now() - timedelta(days=1)).date())
+    make_user(backend, 'lapsed', is_premium=True, premium_until=yesterday,
+              premium_plan='weekly', checks_today=FREE_DAILY_CHECKS)
+    allowed, fields = Database.consume_checks('lapsed', FREE_DAILY_CHECKS)
+    assert not allowed
+    doc = backend.find_one('users', 'lapsed')
+    assert doc['is_premium'] is False and doc['premium_until'] is None and doc['premium_plan'] is None
+
+    # Expiry drops the user onto the free limit rather than refusing outright
+    make_user(backend, 'lapsed-fresh', is_premium=True, premium_until=yesterday, premium_plan='monthly')
+    allowed, fields = Database.consume_checks('lapsed-fresh', FREE_DAILY_CHECKS)
+    assert allowed and fields['is_premium'] is False and fields['checks_today'] == 1
+    print(f"✅ Premium bypasses the limit until it expires on {backend.name}")
+
+def test_premium_without_end_date(backend):
+    # Matches the old can_make_free_check: no premium_until means the free limit applies
+    make_user(backend, 'open-ended', is_premium=True, premium_plan='weekly', checks_today=FREE_DAILY_CHECKS)
+    allowed, fields = Database.consume_checks('open-ended', FREE_DAILY_CHECKS)
+    assert not allowed and 'is_premium' not in fields
+    assert backend.find_one('users', 'open-ended')['is_premium'] is True
+    print(f"✅ Premium without an end date keeps the free limit on {backend.name}")
+
+if __name__ == "__main__":
+    for kind in BACKENDS:
+        for test in (test_free_limit, test_new_day_resets, test_premium_expiry, test_premium_without_end_date):
+            with storage_backend(kind) as backend:
+                test(backend)
@@ -0,0 +1,156 @@
+# test_sms_rules.py
+import json
+import os
+import re
+import tempfile
+
+from app import scanner_rules, builtin_ruleset, Ruleset, ScannerRules, KeywordAutomaton
+
+# Parity is checked against the ruleset the app actually loaded (scanner_rules.json)
+sms_engine = scanner_rules.current().sms
+ussd_engine = scanner_rules.current().ussd
+
+# Original inline scoring from /api/check-sms, kept here as the reference
+LEGACY_PATTERNS = {
+    r'won\s*\d+[,.]?\d*\s*(million|thousand|billion)': 15,
+    r'congratulation(s)?!*\s*you\s+(won|have|are)': 12,
+    r'prize\s*(money|award|winner)': 10,
+    r'lottery|jackpot|raffle': 10,
+    r'claim\s*(your|this|now)': 8,
+    r'free\s*(money|airtime|data|gift)': 8,
+    r'account\s*verification': 7,
+    r'password\s*reset': 7,
+    r'bvn\s*(verification|update)': 15,
+    r'atm\s*card\s*(details|pin)': 15,
+    r'click\s*(link|here|below)': 6,
+    r'http[s]?://|www\.|bit\.ly': 8,
+    r'call\s*0[7-9][0-9]{8,}': 7,
+    r'urgent|immediate|action\s*required': 5
+}
+
+SAMPLES = [
+    "",
+    "Hi mum, I'll be home by 6pm. Please keep some food for me.",
+    "Your OTP is 482913. Do not share it with anyone.",
+    "CONGRATULATIONS!!! You won 5,000,000 million naira in the MTN lottery. Claim your prize money now, call 08012345678",
+    "Dear customer, your BVN update is pending. Click link http://bit.ly/xyz to avoid account suspension. URGENT",
+    "Your ATM card details expired. Send your ATM card PIN for account verification immediately",
+    "Get free airtime and free data today! Visit www.freegifts.com",
+    "Password reset requested. If this wasn't you, click here.",
+    "Jackpot raffle winner! Action required to claim this reward",
+    "Meeting moved to 3pm, bring the report. Thanks.",
+    "call 0901234567 for your prize award",
+    "Congratulation you have been selected. Won 2.5 billion. https://scam.tk",
+]
+
+LEGACY_THRESHOLDS = [(25, 'scam'), (18, 'scam'), (12, 'warning'), (8, 'warning')]
+
+def legacy_check(sms):
+    sms_lower = sms.strip().lower()
+    score = 0
+    reasons = []
+    for pattern, points in LEGACY_PATTERNS.items():
+        if re.search(pattern, sms_lower, re.IGNORECASE):
+            score += points
+            reasons.append(pattern[:30])
+    result_type = 'safe'
+    for threshold, kind in LEGACY_THRESHOLDS:
+        if score >= threshold:
+            result_type = kind
+            break
+    return score, result_type, reasons
+
+def test_verdict_parity():
+    for sms in SAMPLES:
+        score, result_type, reasons = legacy_check(sms)
+        result = sms_engine.check(sms.strip())
+        assert result['risk_score'] == score, (sms, result['risk_score'], score)
+        assert result['type'] == result_type, (sms, result['type'], result_type)
+        assert result['reasons'] == reasons, (sms, result['reasons'], reasons)
+    print(f"✅ Verdict parity on {len(SAMPLES)} sample messages")
+
+def test_threshold_boundaries():
+    expected = {0: 'safe', 7: 'safe', 8: 'warning', 11: 'warning', 12: 'warning',
+                17: 'warning', 18: 'scam', 24: 'scam', 25: 'scam', 200: 'scam'}
+    for score, result_type in expected.items():
+        assert sms_engine.verdict(score)[0] == result_type, (score, result_type)
+    assert sms_engine.verdict(25)[1].startswith('🚨 EXTREME RISK')
+    assert sms_engine.verdict(18)[1].startswith('🚨 HIGH-RISK SCAM')
+    print("✅ Threshold boundaries unchanged")
+
+def test_scan_reports_spans():
+    sms = "Please click here: www.example.com"
+    for reason, points, (start, end) in sms_engine.scan(sms):
+        assert start < end <= len(sms), (reason, start, end)
+    assert len(sms_engine.scan(sms)) == 2
+    print("✅ Matched rules report their spans")
+
+def test_keyword_automaton():
+    automaton = KeywordAutomaton(['he', 'she', 'his', 'hers'])
+    assert sorted(automaton.find_all('ushers')) == [(1, 'she'), (2, 'he'), (2, 'hers')]
+    assert automaton.matches('this') == {'his'}
+    assert KeywordAutomaton([]).find_all('anything') == []
+    print("✅ Keyword automaton reports overlapping hits")
+
+def test_ussd_indicators():
+    indicators = {
+        'password': 10, 'pin': 10, 'bvn': 15, 'winner': 12, 'won': 12,
+        'prize': 12, 'lottery': 12, 'claim': 10, 'verification': 8
+    }
+    for code in ['*901#', '*123*PIN#', '*555*winner*bvn#', '*7*claim*prize#', '*000#']:
+        expected = [kw for kw in indicators if kw in code.lower()]
+        result = ussd_engine.check(code)
+        assert result['reasons'] == expected, (code, result['reasons'])
+        if code != '*901#':
+            assert result['risk_score'] == sum(indicators[kw] for kw in expected), code
+    assert ussd_engine.check('*901#')['message'].startswith('✅ SAFE - Verified')
+    assert ussd_engine.check('*555*winner*bvn#')['type'] == 'scam'
+    print("✅ USSD indicators match substring scoring")
+
+def test_mixed_case_anchors():
+    rules = builtin_ruleset()
+    rules['sms']['rules'].append({'pattern': r'western\s*union', 'points': 30, 'anchors': ['Western', 'UNION']})
+    ruleset = Ruleset.from_dict(rules)
+    result = ruleset.sms.check("Send the fee by WESTERN Union today")
+    assert result['risk_score'] == 30 and result['type'] == 'scam', result
+    print("✅ Mixed-case anchors in the rules file still match")
+
+def test_ruleset_reload():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        rules = builtin_ruleset()
+        rules['version'] = 'test-1'
+        with open(path, 'w') as f:
+            json.dump(rules, f)
+        loader = ScannerRules(path, reload_interval=0)
+        old = loader.current()
+        assert old.version == 'test-1'
+        assert old.sms.check('hi')['ruleset_version'] == 'test-1'
+
+        rules['version'] = 'test-2'
+        rules['sms']['rules'].append({'pattern': r'hi', 'points': 30, 'anchors': ['hi']})
+        with open(path, 'w') as f:
+            json.dump(rules, f)
+        assert loader.reload()
+        new = loader.current()
+        assert new.version == 'test-2' and new.sms.check('hi')['type'] == 'scam'
+        # A request still holding the old ruleset keeps scoring with it
+        assert old.sms.check('hi')['type'] == 'safe'
+
+        with open(path, 'w') as f:
+            f.write('{"version": "broken", "sms": {"rules": [{"pattern": "("}]}}')
+        assert not loader.reload()
+        assert loader.current() is new
+    finally:
+        os.remove(path)
+    print("✅ Ruleset reload swaps atomically and keeps the old rules on a bad file")
+
+if __name__ == "__main__":
+    test_verdict_parity()
+    test_threshold_boundaries()
+    test_scan_reports_spans()
+    test_keyword_automaton()
+    test_ussd_indicators()
+    test_mixed_case_anchors()
+    test_ruleset_reload()